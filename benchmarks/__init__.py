@@ -0,0 +1 @@
+"""Benchmarks of geeservermap, run with ``nox -s bench``."""
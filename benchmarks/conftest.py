@@ -0,0 +1,48 @@
+"""Fixtures of the benchmarks, running the client and the server in process."""
+
+import pytest
+
+from geeservermap import main
+from geeservermap.cache import TileCache
+from geeservermap.transport import Transport
+from tests.fake_ee import FakeEE
+
+
+def pytest_addoption(parser):
+    """Add the latency of the Earth Engine stand-in to the options."""
+    parser.addoption(
+        "--ee-latency",
+        default=0.05,
+        type=float,
+        help="Seconds taken by a round trip to the Earth Engine stand-in",
+    )
+
+
+@pytest.fixture
+def ee(request, monkeypatch):
+    """Earth Engine stand-in used by all the geeservermap modules."""
+    fake = FakeEE(latency=request.config.getoption("--ee-latency"))
+    fake.install(monkeypatch)
+    return fake
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """Flask test client receiving the requests of the Map client.
+
+    The number of requests sent by the client is counted in ``requests``.
+    """
+    state = main.AppState(tile_cache=TileCache(tmp_path / "tiles"))
+    app = main.create_app(state=state)
+    client = app.test_client()
+
+    def request(self, method, path, json=None, params=None, **kwargs):
+        """Send the request to the test client."""
+        client.requests += 1
+        return client.open(path, method=method, json=json, query_string=params).json
+
+    client.app = app
+    client.state = state
+    client.requests = 0
+    monkeypatch.setattr(Transport, "request", request)
+    yield client
@@ -0,0 +1,62 @@
+"""Benchmark adding layers with the Map client."""
+
+import itertools
+
+from geeservermap import Map
+
+VIS = {"bands": ["B1"], "min": 0, "max": 3000}
+
+
+def test_add_layer(benchmark, ee, server):
+    """Latency of adding an image never seen before, with full visParams."""
+    m = Map()
+    counter = itertools.count()
+    benchmark(lambda: m.addLayer(ee.Image(f"image-{next(counter)}"), dict(VIS)))
+
+
+def test_add_layer_without_visparams(benchmark, ee, server):
+    """Latency of adding an image whose bands and ranges have to be fetched."""
+    m = Map()
+    counter = itertools.count()
+    benchmark(lambda: m.addLayer(ee.Image(f"image-{next(counter)}")))
+
+
+def test_add_layer_cached(benchmark, ee, server):
+    """Latency of adding again an image whose map id is cached."""
+    m = Map()
+    image = ee.Image("cached")
+    m.addLayer(image, dict(VIS))
+    benchmark(lambda: m.addLayer(image, dict(VIS)))
+
+
+def test_round_trips(benchmark, ee, server):
+    """Round trips to Earth Engine and to the server per layer added."""
+    m = Map()
+    layers = 20
+
+    def add():
+        ee.round_trips = server.requests = 0
+        for i in range(layers):
+            m.addLayer(ee.Image(f"round-trips-{i}"))
+        return ee.round_trips / layers, server.requests / layers
+
+    ee_trips, server_trips = benchmark.pedantic(add, setup=ee.clear_caches, rounds=3)
+    benchmark.extra_info["ee_round_trips"] = ee_trips
+    benchmark.extra_info["server_round_trips"] = server_trips
+    # the bands and their types in one request, then the map id
+    assert ee_trips == 2
+    assert server_trips == 1
+
+
+def test_add_layers_batch(benchmark, ee, server):
+    """Latency of adding a batch of images computed concurrently."""
+    m = Map()
+    counter = itertools.count()
+
+    def add():
+        batch = next(counter)
+        images = [ee.Image(f"batch-{batch}-{i}") for i in range(8)]
+        return m.addLayers(images)
+
+    results = benchmark(add)
+    assert all("job_id" in r for r in results)
@@ -0,0 +1,57 @@
+"""Benchmark the server endpoints and the job store."""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from geeservermap.async_jobs import Async
+
+
+@pytest.mark.parametrize("clients", [1, 8])
+@pytest.mark.parametrize("layers", [10, 100, 1000])
+def test_messages(benchmark, server, layers, clients):
+    """Time for every client to poll ``/messages`` once."""
+    for i in range(layers):
+        layer = {"url": f"https://ee.test/{i}/tiles/{{z}}/{{x}}/{{y}}", "name": str(i)}
+        server.state.messages.add(layer, str(i))
+    polling = [server.app.test_client() for _ in range(clients)]
+
+    def poll(client):
+        return client.get("/messages").status_code
+
+    with ThreadPoolExecutor(clients) as pool:
+        statuses = benchmark(lambda: list(pool.map(poll, polling)))
+    assert statuses == [200] * clients
+    benchmark.extra_info["requests_per_round"] = clients
+
+
+@pytest.mark.parametrize("layers", [10, 1000])
+def test_messages_since(benchmark, server, layers):
+    """Time to poll ``/messages`` for the changes when nothing changed."""
+    for i in range(layers):
+        server.state.messages.add(
+            {"url": f"https://ee.test/{i}", "name": str(i)}, str(i)
+        )
+    since = server.state.messages.seq
+    response = benchmark(server.get, f"/messages?since={since}")
+    assert response.json == {}
+
+
+@pytest.mark.parametrize("jobs", [1000, 10000, 100000])
+def test_job_cleanup(benchmark, jobs):
+    """Time to remove ``jobs`` expired jobs from the store."""
+
+    def setup():
+        store = Async(max_jobs=jobs)
+        for _ in range(jobs):
+            store._finish_job(store._create_job(), None)
+        return (store,), {}
+
+    def cleanup(store):
+        with store._lock:
+            store._remove_expired(time.time() + store._TIMEOUT)
+        store._terminate()
+        return len(store)
+
+    assert benchmark.pedantic(cleanup, setup=setup, rounds=5) == 0
@@ -1,11 +1,39 @@
 # coding=utf-8
 """TODO Missing docstring."""
 
-from . import helpers as helpers
-from .elements import layers as layers
-from .main import MESSAGES as MESSAGES
-from .map import Map as Map
+import importlib
+from typing import TYPE_CHECKING
 
 __version__ = "0.0.0rc2"
 __author__ = "LDC Research Repository"
 __email__ = "remote-sensing@ldc.com"
+
+# the attributes are imported on first access so that importing the package
+# doesn't import Earth Engine and the client doesn't import the Flask server
+_LAZY = {
+    "helpers": (".helpers", None),
+    "layers": (".elements.layers", None),
+    "Map": (".map", "Map"),
+}
+
+if TYPE_CHECKING:  # pragma: no cover
+    from . import helpers as helpers
+    from .elements import layers as layers
+    from .map import Map as Map
+
+
+def __getattr__(name):
+    """Import the public attributes of the package when they are first used."""
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module, attribute = _LAZY[name]
+    value = importlib.import_module(module, __name__)
+    if attribute is not None:
+        value = getattr(value, attribute)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    """List the attributes of the package, including the ones not imported yet."""
+    return sorted(set(globals()) | set(_LAZY))
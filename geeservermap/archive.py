@@ -0,0 +1,239 @@
+"""Tile archives on the disk of the server, served as layers without Earth Engine.
+
+MBTiles archives are SQLite databases read through read-only connections,
+one per thread and kept open. PMTiles (version 3) archives are memory mapped
+and their tiles located with the directories parsed once and cached, so
+serving a tile opens no file.
+"""
+
+import gzip
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+from bisect import bisect_right
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import brotli
+
+from .cache import MemoryCache
+
+MIMETYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+
+# magic, version, offsets and lengths of the sections, counts, clustered,
+# compressions, tile type, zooms, bounds and center
+HEADER = struct.Struct("<7sB11Q6B4iB2i")
+COMPRESSIONS = {1: None, 2: "gzip", 3: "br"}  # 0 is unknown and 4 zstd
+TILE_TYPES = {2: "png", 3: "jpeg", 4: "webp", 5: "avif"}  # 1 is MVT
+MAX_DEPTH = 4  # the root directory and at most 3 levels of leaf directories
+
+
+def tile_id(z: int, x: int, y: int) -> int:
+    """Get the PMTiles id of a tile, its position on the Hilbert curve of all zooms."""
+    acc = ((1 << 2 * z) - 1) // 3  # number of tiles of the lower zooms
+    d = 0
+    s = 1 << z >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+        s >>= 1
+    return acc + d
+
+
+def _varints(data: bytes):
+    """Decode the unsigned LEB128 varints of ``data``."""
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield value
+            value = shift = 0
+
+
+def _decompress(data: bytes, compression: Optional[str]) -> bytes:
+    """Decompress a directory or a tile of a PMTiles archive."""
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "br":
+        return brotli.decompress(data)
+    return data
+
+
+class MBTiles:
+    """Tile archive in a SQLite database with the MBTiles schema.
+
+    Args:
+        path: the path of the ``.mbtiles`` file
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """Open the archive and read its metadata."""
+        self.path = Path(path).resolve()
+        if not self.path.is_file():
+            raise FileNotFoundError(f"No tile archive at {self.path}")
+        self._local = threading.local()
+        try:
+            rows = self._db.execute("SELECT name, value FROM metadata").fetchall()
+        except sqlite3.DatabaseError as error:
+            raise ValueError(f"{self.path} is not an MBTiles archive: {error}")
+        metadata = dict(rows)
+        self.format = metadata.get("format", "png")
+        if self.format not in MIMETYPES:
+            raise ValueError(f"Unsupported {self.format} tiles in {self.path}")
+        self.mimetype = MIMETYPES[self.format]
+        self.minzoom = int(metadata.get("minzoom", 0))
+        self.maxzoom = int(metadata.get("maxzoom", 22))
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """Read-only connection of the current thread, opened on first use."""
+        db = getattr(self._local, "db", None)
+        # a connection must not be used by a forked process
+        if db is None or self._local.pid != os.getpid():
+            # immutable: the archive doesn't change while served, skip locking
+            uri = f"{self.path.as_uri()}?mode=ro&immutable=1"
+            db = sqlite3.connect(uri, uri=True)
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """Get the content of a tile, None if it isn't in the archive."""
+        row = self._db.execute(
+            "SELECT tile_data FROM tiles "
+            "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, (1 << z) - 1 - y),  # the rows are numbered from the south
+        ).fetchone()
+        return None if row is None else row[0]
+
+
+class PMTiles:
+    """Memory-mapped tile archive in the PMTiles version 3 format.
+
+    Args:
+        path: the path of the ``.pmtiles`` file
+        cache_size: number of leaf directories kept parsed in memory
+    """
+
+    def __init__(self, path: Union[str, Path], cache_size: int = 64):
+        """Map the archive in memory and read its header and root directory."""
+        self.path = Path(path).resolve()
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            raise ValueError(f"{self.path} is not a PMTiles archive")
+        header = HEADER.unpack_from(self._map)
+        magic, version, root_offset, root_length = header[:4]
+        if magic != b"PMTiles" or version != 3:
+            raise ValueError(f"{self.path} is not a PMTiles version 3 archive")
+        self.leaf_offset, self.data_offset = header[6], header[8]
+        internal, compression, tile_type = header[14:17]
+        if internal not in COMPRESSIONS or compression not in COMPRESSIONS:
+            raise ValueError(f"Unsupported compression in {self.path}")
+        if tile_type not in TILE_TYPES:
+            raise ValueError(f"Unsupported tiles in {self.path}, only images are")
+        self.internal = COMPRESSIONS[internal]
+        self.compression = COMPRESSIONS[compression]
+        self.format = TILE_TYPES[tile_type]
+        self.mimetype = MIMETYPES[self.format]
+        self.minzoom, self.maxzoom = header[17:19]
+        self._root = self._read_directory(root_offset, root_length)
+        self._leaves = MemoryCache(max_size=cache_size)
+
+    def _read_directory(self, offset: int, length: int) -> Tuple[List[int], ...]:
+        """Parse the ``(tile_ids, run_lengths, lengths, offsets)`` of a directory."""
+        data = _decompress(self._map[offset : offset + length], self.internal)
+        values = _varints(data)
+        n = next(values)
+        tile_ids, last = [], 0
+        for _ in range(n):
+            last += next(values)
+            tile_ids.append(last)
+        run_lengths = [next(values) for _ in range(n)]
+        lengths = [next(values) for _ in range(n)]
+        offsets: List[int] = []
+        for i in range(n):
+            value = next(values)
+            # 0 means right after the previous entry
+            if value == 0 and i > 0:
+                offsets.append(offsets[i - 1] + lengths[i - 1])
+            else:
+                offsets.append(value - 1)
+        return tile_ids, run_lengths, lengths, offsets
+
+    def _leaf(self, offset: int, length: int) -> Tuple[List[int], ...]:
+        """Get a leaf directory, parsing it the first time."""
+        directory = self._leaves.get(offset)
+        if directory is None:
+            directory = self._read_directory(self.leaf_offset + offset, length)
+            self._leaves.set(offset, directory)
+        return directory
+
+    def tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """Get the content of a tile, None if it isn't in the archive."""
+        if not self.minzoom <= z <= self.maxzoom or not 0 <= max(x, y) < 1 << z:
+            return None
+        tid = tile_id(z, x, y)
+        tile_ids, run_lengths, lengths, offsets = self._root
+        for _ in range(MAX_DEPTH):
+            i = bisect_right(tile_ids, tid) - 1
+            if i < 0:
+                return None
+            if run_lengths[i] == 0:  # the entry points to a leaf directory
+                directory = self._leaf(offsets[i], lengths[i])
+                tile_ids, run_lengths, lengths, offsets = directory
+                continue
+            if tid - tile_ids[i] >= run_lengths[i]:
+                return None
+            start = self.data_offset + offsets[i]
+            data = self._map[start : start + lengths[i]]
+            return _decompress(data, self.compression)
+        return None
+
+
+class TileArchives:
+    """Archives opened by the server, each one opened once and shared by the layers."""
+
+    def __init__(self):
+        """Initialize without opening any archive."""
+        self._archives: Dict[Path, Union[MBTiles, PMTiles]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: Union[str, Path]) -> Union[MBTiles, PMTiles]:
+        """Get an archive, opening it the first time.
+
+        Args:
+            path: the path of a ``.mbtiles`` or ``.pmtiles`` file
+
+        Raises:
+            ValueError: if the file isn't a supported archive of images
+            OSError: if the file can't be read
+        """
+        path = Path(path).resolve()
+        with self._lock:
+            archive = self._archives.get(path)
+            if archive is None:
+                if path.suffix == ".mbtiles":
+                    archive = MBTiles(path)
+                elif path.suffix == ".pmtiles":
+                    archive = PMTiles(path)
+                else:
+                    raise ValueError(
+                        f"Unknown tile archive {path}, use MBTiles or PMTiles"
+                    )
+                self._archives[path] = archive
+            return archive
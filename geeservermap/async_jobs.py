@@ -1,11 +1,13 @@
 """TODO Missing docstring."""
 
 import atexit
+import heapq
+import queue
+import threading
 import time
 import uuid
-from contextlib import suppress
-from copy import deepcopy
-from threading import Thread
+
+from .exceptions import TooManyJobs
 
 
 class Async:
@@ -13,36 +15,129 @@ class Async:
 
     _INTERVAL = 60
     _TIMEOUT = 300
+    MAX_WORKERS = 4
+    MAX_JOBS = 10000
 
-    def __init__(self):
-        """TODO Missing docstring."""
+    def __init__(self, max_workers=MAX_WORKERS, max_jobs=MAX_JOBS):
+        """Create an empty job store, its threads start with the first job.
+
+        Args:
+            max_workers: maximum number of jobs submitted with ``submit`` that
+                run at the same time, the others wait in a queue
+            max_jobs: maximum number of jobs kept in the store
+        """
+        self.max_jobs = max_jobs
         self._jobs = {}
-        self.cleanup_running = False
+        # (expiry time, job id) of the finished jobs, the first one expires first
+        self._expiry = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.cleanup_thread = None
+        self.max_workers = max_workers
+        # daemon workers: the interpreter doesn't wait for them at exit, unlike
+        # the ones of a ThreadPoolExecutor which are joined before atexit runs
+        self._queue: queue.Queue = queue.Queue()
+        self._workers: list = []
         atexit.register(self._terminate)
 
+    def __len__(self):
+        """Number of jobs in the store."""
+        return len(self._jobs)
+
+    def stats(self):
+        """Count the jobs of each state and get the age of the oldest pending one."""
+        now = time.time()
+        with self._lock:
+            jobs = list(self._jobs.values())
+        states = {"created": 0, "queued": 0, "started": 0}
+        oldest = 0.0
+        for job in jobs:
+            states[job["state"]] = states.get(job["state"], 0) + 1
+            if not job["ready"]:
+                oldest = max(oldest, now - job["created"])
+        return {"jobs": len(jobs), "states": states, "oldest": oldest}
+
     def _run_cleanup(self):
-        """TODO Missing docstring."""
-        self.cleanup_thread = Thread(target=self._cleanup_timedout_jobs)
-        self.cleanup_thread.start()
+        """Start the thread removing the expired jobs, must hold the lock."""
+        if self.cleanup_thread is None:
+            self.cleanup_thread = threading.Thread(
+                target=self._cleanup_timedout_jobs, daemon=True
+            )
+            self.cleanup_thread.start()
+
+    def _run_workers(self):
+        """Start the workers running the submitted jobs, must hold the lock."""
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self._work, name=f"asyncgee-{len(self._workers)}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        """Run the queued jobs until the store is terminated."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                item[1]()
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Wait for the submitted jobs to end."""
+        self._queue.join()
 
-    # This MUST be called when flask wants to exit otherwise the process will hang for a while
     def _terminate(self):
-        """TODO Missing docstring."""
-        self._jobs = None
-        with suppress(Exception):
-            self.cleanup_thread.join()
+        """Stop the cleanup thread and the workers without waiting for the jobs.
+
+        The queued jobs are dropped and the running ones are asked to stop.
+        """
+        self._stop.set()
+        while True:
+            try:
+                job, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            except TypeError:  # the None stopping a worker
+                self._queue.task_done()
+                continue
+            self._end_job(job, "cancelled")
+            self._queue.task_done()
+        with self._lock:
+            for job in self._jobs.values():
+                if not job["ready"]:
+                    job["cancelled"] = True
+            for _ in self._workers:
+                self._queue.put(None)
+            self._workers = []
+        if self.cleanup_thread is not None:
+            self.cleanup_thread.join(timeout=1)
 
     def get_job_result(self, job_id):
-        """TODO Missing docstring."""
-        if not self._jobs:
-            return None
-        job = self._jobs.get(job_id)
-        if job["state"] in ["finished", "failed"]:
-            self.remove_job(job)
-        return job
+        """Get a copy of a job, a job that ended is removed once read.
+
+        Args:
+            job_id: the id of the job
+
+        Returns:
+            the job or None if it doesn't exist (anymore)
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job["ready"]:
+                del self._jobs[job_id]
+            return dict(job)
 
     def _create_job(self):
-        """TODO Missing docstring."""
+        """Create a job, making room for it if the store is full.
+
+        Raises:
+            TooManyJobs: when the store is full of jobs that are not finished
+        """
         job = {
             "id": uuid.uuid4().hex,
             "ready": False,
@@ -51,12 +146,63 @@ class Async:
             "state": "created",
             "finished": None,
         }
-        self._jobs[job["id"]] = job
-        if not self.cleanup_running:
+        with self._lock:
+            self._remove_expired(time.time())
+            # evict the finished jobs that would expire first
+            while len(self._jobs) >= self.max_jobs and self._expiry:
+                _, job_id = heapq.heappop(self._expiry)
+                self._jobs.pop(job_id, None)
+            if len(self._jobs) >= self.max_jobs:
+                raise TooManyJobs(self.max_jobs)
+            self._jobs[job["id"]] = job
             self._run_cleanup()
-            self.cleanup_running = True
         return job
 
+    def submit(self, func, *args, track=False, **kwargs):
+        """Run ``func`` in the worker pool and return the job tracking it.
+
+        The job is ``queued`` until a worker is available, then ``started``. Its
+        result is the value returned by ``func`` once ``finished``, or the error
+        message if it ``failed``.
+
+        With ``track``, the job is passed as the first argument of ``func`` so it
+        can report its ``progress`` and stop early when ``cancelled`` is set, in
+        which case it ends in the ``cancelled`` state.
+        """
+        if self._stop.is_set():
+            raise RuntimeError("The job store is terminated")
+        job = self._create_job()
+        job["state"] = "queued"
+        job["cancelled"] = False
+        if track:
+            args = (job, *args)
+
+        def work():
+            if job["cancelled"]:
+                self._end_job(job, "cancelled")
+                return
+            job["state"] = "started"
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self._fail_job(job, str(e))
+            else:
+                self._finish_job(job, result)
+
+        with self._lock:
+            self._run_workers()
+            self._queue.put((job, work))
+        return job
+
+    def cancel(self, job_id):
+        """Ask a job to stop, return False if it doesn't exist or already ended."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["ready"]:
+                return False
+            job["cancelled"] = True
+        return True
+
     def _start_job(self, thread, job):
         """TODO Missing docstring."""
         job["state"] = "started"
@@ -64,44 +210,48 @@ class Async:
         thread.start()
 
     def _finish_job(self, job, result):
-        """TODO Missing docstring."""
-        job["ready"] = True
-        job["state"] = "finished"
-        if self._is_job_alive(job):
-            job["result"] = result
+        """Mark the job as finished (or cancelled if asked to) with its ``result``."""
+        job["result"] = result
+        self._end_job(job, "cancelled" if job.get("cancelled") else "finished")
+
+    def _fail_job(self, job, error):
+        """Mark the job as failed with the ``error`` message."""
+        job["error"] = error
+        self._end_job(job, "failed")
+
+    def _end_job(self, job, state):
+        """Set the final state of a job and schedule its expiry."""
+        with self._lock:
+            job["ready"] = True
+            job["state"] = state
             job["finished"] = time.time()
+            if self._is_job_alive(job):
+                expiry = (job["finished"] + self._TIMEOUT, job["id"])
+                heapq.heappush(self._expiry, expiry)
 
     def remove_job(self, job):
         """TODO Missing docstring."""
-        if self._jobs and job["id"] in self._jobs:
-            # logger.info(f'removing job {job["id"]}')
-            del self._jobs[job["id"]]
+        with self._lock:
+            self._jobs.pop(job["id"], None)
 
     def _is_job_alive(self, job):
         """TODO Missing docstring."""
-        return (
-            self._jobs
-            and job is not None
-            and job["id"] in self._jobs
-            and job["ready"] is not None
-        )
-
-    # Iterate though jobs every minute and remove the stale ones
+        return job is not None and job["id"] in self._jobs
+
+    def _remove_expired(self, now):
+        """Remove the jobs that expired before ``now``, must hold the lock."""
+        while self._expiry and self._expiry[0][0] <= now:
+            _, job_id = heapq.heappop(self._expiry)
+            self._jobs.pop(job_id, None)
+
     def _cleanup_timedout_jobs(self):
-        """TODO Missing docstring."""
-        next_cleanup_time = time.time()
-        while self._jobs is not None:
-            time.sleep(5)
-            now = time.time()
-            proxy = deepcopy(self._jobs)
-            if proxy and now >= next_cleanup_time:
-                for job in proxy.values():
-                    if job["state"] == "finished" and (
-                        job["finished"] + self._TIMEOUT > now
-                    ):
-                        self.remove_job(job)
-                next_cleanup_time = time.time() + self._INTERVAL
-        self.cleanup_running = False
+        """Remove the expired jobs, waking up when the next one expires."""
+        while not self._stop.is_set():
+            with self._lock:
+                now = time.time()
+                self._remove_expired(now)
+                wait = self._expiry[0][0] - now if self._expiry else self._INTERVAL
+            self._stop.wait(min(wait, self._INTERVAL))
 
 
 asyncgee = Async()
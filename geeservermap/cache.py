@@ -0,0 +1,211 @@
+"""Caches used to avoid computing or fetching the same data twice."""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Hashable, Optional, Union
+
+DEFAULT_TILE_DIR = Path(tempfile.gettempdir()) / "geeservermap" / "tiles"
+
+
+class MemoryCache:
+    """Thread-safe in-memory LRU cache whose entries expire after ``ttl`` seconds.
+
+    Args:
+        max_size: maximum number of entries, the least recently used are evicted
+        ttl: lifetime of an entry in seconds, None to keep them until evicted
+    """
+
+    def __init__(self, max_size: int = 256, ttl: Optional[float] = None):
+        """Initialize an empty cache."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        """Number of entries in the cache, expired or not."""
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a value from the cache.
+
+        Args:
+            key: the key of the value
+            default: the value returned when the key is missing or expired
+
+        Returns:
+            the cached value or ``default``
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                self._data.pop(key, None)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any):
+        """Store a value in the cache.
+
+        Args:
+            key: the key of the value
+            value: the value to store
+        """
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all the entries from the cache."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Get the hit/miss counters and the size of the cache."""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class TileCache:
+    """Size-bounded tile cache with an in-memory hot tier and an on-disk LRU tier.
+
+    Every tile is written to disk and the most recently used ones are also kept
+    in memory. When a tier grows over its size limit, the least recently used
+    tiles are evicted from it.
+
+    Args:
+        directory: the folder where the tiles are stored
+        max_size: maximum size of the disk tier in bytes
+        memory_size: maximum size of the memory tier in bytes
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path] = DEFAULT_TILE_DIR,
+        max_size: int = 512 * 2**20,
+        memory_size: int = 32 * 2**20,
+    ):
+        """Initialize the cache and index the tiles already stored in ``directory``."""
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.memory_size = memory_size
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory: OrderedDict = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict = OrderedDict()
+        self._disk_bytes = 0
+        self._load()
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Build a cache key out of the parts identifying a tile."""
+        return hashlib.sha1("/".join(str(p) for p in parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        """Path of a tile on disk, sharded by the first characters of the key."""
+        return self.directory / key[:2] / key
+
+    def _load(self):
+        """Index the existing tiles, the least recently used first."""
+        if not self.directory.is_dir():
+            return
+        files = [f for f in self.directory.glob("*/*") if not f.suffix]
+        stats = sorted(((f.stat(), f) for f in files), key=lambda s: s[0].st_mtime)
+        for stat, file in stats:
+            self._disk[file.name] = stat.st_size
+            self._disk_bytes += stat.st_size
+        with self._lock:
+            self._evict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Get a tile from the cache.
+
+        Args:
+            key: the key of the tile
+
+        Returns:
+            the content of the tile or None if it's not cached
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return self._memory[key]
+            if key not in self._disk:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(key)
+        try:
+            path = self._path(key)
+            data = path.read_bytes()
+            os.utime(path)  # keep the LRU order across restarts
+        except OSError:
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits["disk"] += 1
+            self._remember(key, data)
+        return data
+
+    def set(self, key: str, data: bytes):
+        """Store a tile in both tiers of the cache.
+
+        Args:
+            key: the key of the tile
+            data: the content of the tile
+        """
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{key}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._disk_bytes -= self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._remember(key, data)
+            self._evict()
+
+    def _remember(self, key: str, data: bytes):
+        """Put a tile in the memory tier, must be called holding the lock."""
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_size and self._memory:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old)
+
+    def _evict(self):
+        """Remove the least recently used tiles from disk, must hold the lock."""
+        while self._disk_bytes > self.max_size and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._path(key).unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        """Get the hit/miss counters and the size of each tier."""
+        with self._lock:
+            return {
+                "hits": dict(self.hits),
+                "misses": self.misses,
+                "memory": {"tiles": len(self._memory), "bytes": self._memory_bytes},
+                "disk": {"tiles": len(self._disk), "bytes": self._disk_bytes},
+                "max_size": self.max_size,
+                "memory_size": self.memory_size,
+            }
@@ -0,0 +1,68 @@
+"""Blend the tiles of stacked layers into a single tile.
+
+Needs the ``composite`` extra: ``pip install geeservermap[composite]``.
+"""
+
+import io
+from importlib.util import find_spec
+from typing import List, Optional, Tuple
+
+AVAILABLE = find_spec("numpy") is not None and find_spec("PIL") is not None
+if AVAILABLE:
+    import numpy as np
+    from PIL import Image
+
+FORMATS = {"png": "image/png", "webp": "image/webp"}
+
+
+def available() -> bool:
+    """Whether numpy and Pillow are installed."""
+    return AVAILABLE
+
+
+def _rgba(data: bytes, size: Optional[Tuple[int, int]]):
+    """Decode a tile as an array of RGBA floats between 0 and 1."""
+    image = Image.open(io.BytesIO(data)).convert("RGBA")
+    if size is not None and image.size != size:
+        image = image.resize(size)
+    return np.asarray(image, dtype=np.float32) / 255
+
+
+def blend(tiles: List[Tuple[Optional[bytes], float]], format: str = "png") -> bytes:
+    """Stack tiles over each other, the first one being at the bottom.
+
+    Args:
+        tiles: the content of each tile, None for a missing one, and the
+            opacity of its layer
+        format: the format of the result, ``png`` or ``webp``
+
+    Returns:
+        the encoded tile
+    """
+    if not available():
+        raise ImportError("compositing needs: pip install geeservermap[composite]")
+    result = size = None
+    for data, opacity in tiles:
+        if data is None:
+            continue
+        rgba = _rgba(data, size)
+        alpha = rgba[..., 3:] * (1 if opacity is None else opacity)
+        if result is None:
+            size = rgba.shape[1::-1]
+            result = np.zeros_like(rgba)
+        # "over" operator on colors premultiplied by their alpha
+        result[..., :3] = rgba[..., :3] * alpha + result[..., :3] * (1 - alpha)
+        result[..., 3:] = alpha + result[..., 3:] * (1 - alpha)
+    if result is None:
+        result = np.zeros((256, 256, 4), dtype=np.float32)
+    covered = result[..., 3:] > 0
+    result[..., :3] = np.divide(
+        result[..., :3],
+        result[..., 3:],
+        out=np.zeros_like(result[..., :3]),
+        where=covered,
+    )
+    out = io.BytesIO()
+    pixels = np.rint(result * 255).astype(np.uint8)
+    Image.fromarray(pixels).save(out, format=format.upper())
+    return out.getvalue()
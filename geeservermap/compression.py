@@ -0,0 +1,89 @@
+"""Compression of the responses negotiated with the ``Accept-Encoding`` header."""
+
+import gzip
+import hashlib
+
+import brotli
+
+from . import tracing
+from .cache import MemoryCache
+
+MIN_SIZE = 512  # bytes under which compressing isn't worth it
+ENCODINGS = ["br", "gzip"]  # in order of preference
+
+
+def _compressible(mimetype: str) -> bool:
+    """Whether the content is text, PNG, JPEG and WebP tiles are already compressed."""
+    return (
+        mimetype.startswith("text/")
+        or mimetype.endswith("json")
+        or mimetype in ["application/javascript", "image/svg+xml"]
+    )
+
+
+class Compressor:
+    """Compress the responses with brotli or gzip, caching the compressed bodies.
+
+    Identical bodies, e.g. the same layers sent to every polling client, are
+    compressed only once.
+
+    Args:
+        min_size: size in bytes under which the responses are sent as is
+        cache_size: number of compressed bodies kept in memory
+    """
+
+    def __init__(self, min_size: int = MIN_SIZE, cache_size: int = 256):
+        """Initialize the cache of compressed bodies."""
+        self.min_size = min_size
+        self.cache = MemoryCache(max_size=cache_size)
+
+    @staticmethod
+    def negotiate(accept_encodings) -> str:
+        """Get the preferred encoding accepted by the client, ``identity`` if none."""
+        quality = {e: accept_encodings[e] for e in ENCODINGS}
+        best = max(ENCODINGS, key=lambda e: quality[e])
+        return best if quality[best] > 0 else "identity"
+
+    def compress(self, data: bytes, encoding: str) -> bytes:
+        """Compress ``data``, reusing the result if it was compressed before."""
+        key = (encoding, hashlib.sha1(data).digest())
+        compressed = self.cache.get(key)
+        if compressed is None:
+            if encoding == "br":
+                compressed = brotli.compress(data, quality=5)
+            else:
+                compressed = gzip.compress(data, compresslevel=6, mtime=0)
+            self.cache.set(key, compressed)
+        return compressed
+
+    def apply(self, request, response):
+        """Compress a Flask response if the client and the content allow it.
+
+        Args:
+            request: the request being answered
+            response: the response to compress
+
+        Returns:
+            the response
+        """
+        if (
+            response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or not _compressible(response.mimetype or "")
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = self.negotiate(request.accept_encodings)
+        data = response.get_data()
+        if encoding == "identity" or len(data) < self.min_size:
+            return response
+        with tracing.span("compress"):
+            response.set_data(self.compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            # the compressed body is not byte for byte the one of the ETag
+            response.set_etag(etag, weak=True)
+        return response
@@ -1,10 +1,17 @@
 """TODO Missing docstring."""
 
+import json
 from typing import Union
 
 import ee
 
-from .. import helpers
+from .. import helpers, tracing
+from ..cache import MemoryCache
+from ..metrics import EE_CALLS
+
+MAPID_TTL = 3600  # seconds, stay well under the lifetime of an EE map id
+MAPID_CACHE = MemoryCache(max_size=256, ttl=MAPID_TTL)
+"""Tile URLs already minted for an image expression and its visParams."""
 
 
 class VisParams:
@@ -68,28 +75,47 @@ class VisParams:
 
     @classmethod
     def from_image(cls, image, visParams=None):
-        """TODO Missing docstring."""
-        visParams = visParams or {}
+        """Complete the visParams of an image with its bands and their ranges.
+
+        The missing min and max come from the range of the band types, or from
+        the percentiles of the bands over the ``stretch`` region of the
+        visParams (a ``[west, south, east, north]`` box or an ee.Geometry), see
+        :func:`geeservermap.helpers.getStretch`.
+        """
+        visParams = dict(visParams or {})
+        region = visParams.pop("stretch", None)
+        stretch = region is not None and not {"min", "max"}.issubset(visParams)
+        # band names and types are fetched at once and only if needed
+        info = None
+        needed = {"bands"} if stretch else {"bands", "min", "max"}
+        if not needed.issubset(visParams):
+            with tracing.span("bandsInfo"):
+                info = helpers.getBandsInfo(image)
         if "bands" not in visParams:
-            bands = image.bandNames().getInfo()
+            bands = info["names"]
         else:
             bands = visParams["bands"]
         bands = cls.__format_bands(bands)
         visParams["bands"] = bands
 
+        if stretch:
+            with tracing.span("stretch"):
+                stretched = helpers.getStretch(image, bands, region)
+            if stretched is not None:
+                visParams.setdefault("min", stretched[0])
+                visParams.setdefault("max", stretched[1])
+            elif info is None:
+                info = helpers.getBandsInfo(image)
+
         # Min and max
-        btypes = None
+        if info is not None:
+            btypes = [info["types"].get(band, {}) for band in bands]
         if "min" not in visParams:
-            image = image.select(visParams["bands"])
-            btypes = image.bandTypes().getInfo()
-            mins = [btype.get("min") for bname, btype in btypes.items()]
+            mins = [btype.get("min") for btype in btypes]
             mins = [m or 0 for m in mins]
             visParams["min"] = mins
         if "max" not in visParams:
-            image = image.select(visParams["bands"])
-            if not btypes:
-                btypes = image.bandTypes().getInfo()
-            maxs = [btype.get("max") for bname, btype in btypes.items()]
+            maxs = [btype.get("max") for btype in btypes]
             maxs = [m or 1 for m in maxs]
             visParams["max"] = maxs
 
@@ -142,17 +168,18 @@ class MapLayer:
 class Image:
     """TODO Missing docstring."""
 
-    def __init__(self, image: ee.Image, visParams: VisParams):
+    def __init__(self, image: ee.Image, visParams: VisParams, cache: bool = True):
         """TODO Missing docstring."""
         self.image = image
         self.visParams = visParams
+        self.cache = cache
 
     def bands(self):
         """Get bands from visParams or from the image directly."""
         if self.visParams.bands:
             return self.visParams.bands
         else:
-            bandnames = self.image.bandNames().getInfo()
+            bandnames = helpers.getBandsInfo(self.image)["names"]
             if len(bandnames) < 3:
                 bands = bandnames[0:1]
             else:
@@ -164,9 +191,17 @@ class Image:
         """Image Tiles URL."""
         params = self.visParams.for_mapid()
         # params.setdefault('bands', self.bands()) # set bands if not passed in visparams
-        image_info = self.image.getMapId(params)
+        if self.cache:
+            key = (self.image.serialize(), json.dumps(params, sort_keys=True))
+            tiles = MAPID_CACHE.get(key)
+            if tiles is not None:
+                return tiles
+        with EE_CALLS.time("getMapId"), tracing.span("getMapId"):
+            image_info = self.image.getMapId(params)
         fetcher = image_info["tile_fetcher"]
         tiles = fetcher.url_format
+        if self.cache:
+            MAPID_CACHE.set(key, tiles)
         return tiles
 
     def layer(self, opacity=1, visible=True):
@@ -174,13 +209,50 @@ class Image:
         return MapLayer(self.url, opacity, visible)
 
 
+class VectorLayer:
+    """Vector layer whose features are served in tiles by the backend."""
+
+    COLOR = "#3388ff"
+
+    def __init__(self, geojson, opacity, visible, color=COLOR):
+        """Describe a vector layer out of its features.
+
+        Args:
+            geojson: the GeoJSON FeatureCollection of the features
+            opacity: the opacity of the layer, clamped between 0 and 1
+            visible: whether the layer is shown
+            color: the CSS color of the features
+        """
+        self.geojson = geojson
+        self.opacity = min(max(opacity, 0), 1)
+        self.visible = visible
+        self.color = color
+
+    def info(self):
+        """Get the message to send to the backend."""
+        return {
+            "type": "vector",
+            "geojson": self.geojson,
+            "color": self.color,
+            "visible": self.visible,
+            "opacity": self.opacity,
+        }
+
+
 class Geometry:
-    """TODO Missing docstring."""
+    """Geometry, Feature or FeatureCollection displayed as a vector layer."""
 
-    def __init__(self, geometry: ee.Geometry):
+    def __init__(self, geometry: Union[ee.Geometry, ee.Feature, ee.FeatureCollection]):
         """TODO Missing docstring."""
         self.geometry = geometry
 
-    def layer(self, opacity=1, visible=True):
-        """TODO Missing docstring."""
-        pass
+    def geojson(self):
+        """Get the features as a GeoJSON FeatureCollection."""
+        collection = self.geometry
+        if not isinstance(collection, ee.FeatureCollection):
+            collection = ee.FeatureCollection([ee.Feature(collection)])
+        return helpers.getFeatures(collection)
+
+    def layer(self, opacity=1, visible=True, color=VectorLayer.COLOR):
+        """Layer for adding to map."""
+        return VectorLayer(self.geojson(), opacity, visible, color)
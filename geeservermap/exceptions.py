@@ -11,3 +11,23 @@ server follow instructions on <link>. If the server is running in a
 different port, you must specify it when creating the Map instance:
 Map = geeservermap.Map(port=xxxx)"""
         super().__init__(self.message)
+
+
+class TooManyJobs(Exception):
+    """Raised when the job store is full of jobs that are not finished."""
+
+    def __init__(self, max_jobs):
+        """Build the message out of the maximum number of jobs."""
+        self.message = f"""The server is already running {max_jobs} jobs, wait for
+some of them to finish before submitting new ones."""
+        super().__init__(self.message)
+
+
+class TooManySessions(Exception):
+    """Raised when a session can't be opened because the others have layers."""
+
+    def __init__(self, max_sessions):
+        """Build the message out of the maximum number of sessions."""
+        self.message = f"""The server already keeps {max_sessions} sessions with layers in
+memory, clear some of them before opening new ones."""
+        super().__init__(self.message)
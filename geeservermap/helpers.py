@@ -1,5 +1,20 @@
 """TODO Missing docstring."""
 
+import math
+
+import ee
+
+from .cache import MemoryCache
+from .metrics import EE_CALLS
+
+BANDS_CACHE = MemoryCache(max_size=256)
+"""Band names and types already fetched for an image expression."""
+
+STRETCH_PERCENTILES = (2, 98)
+STRETCH_MAX_PIXELS = 65536  # pixels reduced at most, about a 256x256 thumbnail
+STRETCH_CACHE = MemoryCache(max_size=256)
+"""Stretch ranges already computed for an image expression, its bands and a region."""
+
 
 def visparamsStrToList(params):
     """Transform a string formatted as needed by ee.data.getMapId to a list.
@@ -38,6 +53,118 @@ def visparamsListToStr(params):
     return newbands
 
 
+def getBandsInfo(image):
+    """Get the names and the types of the bands of an image in a single request.
+
+    The types contain the range of the integer bands. The result is cached per
+    image expression so adding the same image again doesn't call EE.
+
+    Args:
+        image: the ee.Image to inspect
+
+    Returns:
+        a dict with the list of band ``names`` and the ``types`` of each band
+    """
+    key = image.serialize()
+    info = BANDS_CACHE.get(key)
+    if info is None:
+        query = ee.Dictionary({"names": image.bandNames(), "types": image.bandTypes()})
+        with EE_CALLS.time("bandsInfo"):
+            info = query.getInfo()
+        BANDS_CACHE.set(key, info)
+    return info
+
+
+def _stretchRegion(region, max_pixels):
+    """Get the geometry, the scale and a cache key of a stretch region.
+
+    The scale of a ``[west, south, east, north]`` box is chosen so the box holds
+    about ``max_pixels`` pixels. The scale of a geometry is left to EE, which
+    coarsens it until the geometry holds less than ``max_pixels`` pixels.
+    """
+    if not isinstance(region, (list, tuple)):
+        return region, None, region.serialize()
+    west, south, east, north = (float(c) for c in region)
+    west, east = max(west, -180), min(east, 180)
+    south, north = max(south, -85), min(north, 85)
+    middle = math.radians((south + north) / 2)
+    width = (east - west) * 111320 * math.cos(middle)
+    height = (north - south) * 110574
+    scale = max(math.sqrt(abs(width * height) / max_pixels), 1)
+    box = [west, south, east, north]
+    key = tuple(round(c, 4) for c in box)
+    return ee.Geometry.Rectangle(box, None, False), scale, key
+
+
+def getStretch(image, bands, region, percentiles=STRETCH_PERCENTILES):
+    """Get a min and max stretching the bands of an image over a region.
+
+    The min and max are the lowest and highest ``percentiles`` of the bands,
+    computed at a coarse scale so that at most ``STRETCH_MAX_PIXELS`` pixels
+    are reduced whatever the size of the region. The result is cached per
+    image expression, bands and region.
+
+    Args:
+        image: the ee.Image to stretch
+        bands: the names of the bands shown
+        region: a ``[west, south, east, north]`` box or an ee.Geometry
+        percentiles: the low and high percentiles
+
+    Returns:
+        the min and the max, or None if the region has no valid pixel
+    """
+    geometry, scale, region_key = _stretchRegion(region, STRETCH_MAX_PIXELS)
+    key = (image.serialize(), tuple(bands), region_key, tuple(percentiles))
+    stretch = STRETCH_CACHE.get(key)
+    if stretch is None:
+        stats = image.select(list(bands)).reduceRegion(
+            reducer=ee.Reducer.percentile(list(percentiles)),
+            geometry=geometry,
+            scale=scale,
+            bestEffort=True,
+            maxPixels=STRETCH_MAX_PIXELS,
+        )
+        with EE_CALLS.time("stretch"):
+            stats = stats.getInfo()
+        low, high = percentiles
+        lows = [stats.get(f"{b}_p{low}") for b in bands]
+        highs = [stats.get(f"{b}_p{high}") for b in bands]
+        if None in lows or None in highs:
+            return None
+        # the same range for all the bands keeps the balance of the colors
+        stretch = (min(lows), max(highs))
+        STRETCH_CACHE.set(key, stretch)
+    return stretch
+
+
+def getFeatures(collection, page_size=1000):
+    """Get all the features of a collection as a GeoJSON FeatureCollection.
+
+    The features are fetched page by page so large collections are not limited
+    by the number of elements ``getInfo`` accepts.
+
+    Args:
+        collection: the ee.FeatureCollection
+        page_size: number of features fetched per request
+
+    Returns:
+        the GeoJSON FeatureCollection
+    """
+    if not hasattr(ee.data, "computeFeatures"):
+        with EE_CALLS.time("getInfo"):
+            return collection.getInfo()
+    params = {"expression": collection, "pageSize": page_size}
+    features = []
+    while True:
+        with EE_CALLS.time("computeFeatures"):
+            page = ee.data.computeFeatures(params)
+        features.extend(page.get("features", []))
+        if "nextPageToken" not in page:
+            break
+        params["pageToken"] = page["nextPageToken"]
+    return {"type": "FeatureCollection", "features": features}
+
+
 def getImageTile(image, visParams, visible=True):
     """Get image's tiles uri."""
     proxy = {}
@@ -45,14 +172,14 @@ def getImageTile(image, visParams, visible=True):
 
     # BANDS #############
     def default_bands(image):
-        bandnames = image.bandNames().getInfo()
+        bandnames = getBandsInfo(image)["names"]
         if len(bandnames) < 3:
             bands = [bandnames[0]]
         else:
             bands = [bandnames[0], bandnames[1], bandnames[2]]
         return bands
 
-    bands = params.get("bands", default_bands(image))
+    bands = params["bands"] if "bands" in params else default_bands(image)
 
     # if the passed bands is a string formatted like required by GEE, get the
     # list out of it
@@ -92,12 +219,10 @@ def getImageTile(image, visParams, visible=True):
             "uint32": (2**32) - 1,
             "int64": ((2**64) - 1) / 2,
         }
+        btypes = getBandsInfo(image)["types"]
         for band in bands:
-            ty = image.select([band]).getInfo()["bands"][0]["data_type"]
-            try:
-                themax = maxs[ty]
-            except Exception:
-                themax = 1
+            btype = btypes.get(band, {})
+            themax = btype.get("max") or maxs.get(btype.get("precision"), 1)
             proxy_maxs.append(themax)
         return proxy_maxs
 
@@ -123,7 +248,8 @@ def getImageTile(image, visParams, visible=True):
             print("Can't use palette parameter with more than one band")
 
     # Get the MapID and Token after applying parameters
-    image_info = image.getMapId(proxy)
+    with EE_CALLS.time("getMapId"):
+        image_info = image.getMapId(proxy)
     fetcher = image_info["tile_fetcher"]
     tiles = fetcher.url_format
     attribution = (
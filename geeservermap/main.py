@@ -2,72 +2,1165 @@
 
 # from dotenv import load_dotenv
 import argparse
+import functools
+import itertools
+import json
+import math
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
 
-from flask import Flask, jsonify, render_template, request
+import ee
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    abort,
+    current_app,
+    g,
+    jsonify,
+    render_template,
+    request,
+)
 
-MESSAGES = {}
+from . import composite, helpers, tracing
+from .archive import TileArchives
+from .async_jobs import Async, asyncgee
+from .cache import DEFAULT_TILE_DIR, MemoryCache, TileCache
+from .compression import Compressor
+from .elements import layers
+from .exceptions import TooManyJobs, TooManySessions
+from .metrics import EE_CALLS, METRICS
+from .registry import (
+    DEFAULT_SQLITE_PATH,
+    MAX_LAYERS,
+    SESSION_NAME,
+    BaseRegistry,
+    LayerRegistry,
+    Sessions,
+    open_registry,
+)
+from .serving import THREADS, WORKERS, serve
+from .transport import HOST, PORT
+from .upstream import CONCURRENCY, RATE, Upstream
+from .vector import VectorStore, tile_range
 
 # load_dotenv()  # Load environment variable from .env
-PORT = 8018
 WIDTH = 800
 HEIGHT = 600
+HEARTBEAT = 15  # seconds between two keep-alive comments on /events
+CACHE_SIZE = 512  # MB of tiles kept on disk
+TILE_MAX_AGE = 86400  # seconds a browser can reuse a tile without asking again
+SEED_WORKERS = 8  # tiles fetched at the same time by a seeding job
+SEED_JOBS = 2  # seeding jobs run at the same time
+MAX_SEED_TILES = 100000
+MAX_SEED_ZOOM = 24
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
-    "--port", default=PORT, help=f"Port in which the app will run. Defaults to {PORT}"
+    "--port",
+    default=PORT,
+    type=int,
+    help=f"Port in which the app will run. Defaults to {PORT}",
+)
+parser.add_argument(
+    "--host",
+    default=HOST,
+    help=f"Address the app will listen to, 0.0.0.0 for all. Defaults to {HOST}",
 )
 parser.add_argument(
-    "--width", default=WIDTH, help=f"Width of the map's pane. Defaults to {WIDTH} px"
+    "--width",
+    default=WIDTH,
+    type=int,
+    help=f"Width of the map's pane. Defaults to {WIDTH} px",
 )
 parser.add_argument(
     "--height",
     default=HEIGHT,
+    type=int,
     help=f"Height of the map's pane. Defaults to {HEIGHT} px",
 )
+parser.add_argument(
+    "--workers",
+    default=WORKERS,
+    type=int,
+    help=f"Number of server processes, they use the sqlite store. Defaults to {WORKERS}",
+)
+parser.add_argument(
+    "--threads",
+    default=THREADS,
+    type=int,
+    help=f"Number of threads of each server process. Defaults to {THREADS}",
+)
+parser.add_argument(
+    "--debug",
+    action="store_true",
+    help="Run the single-threaded development server with reloader and debugger",
+)
+parser.add_argument(
+    "--cache-dir",
+    default=DEFAULT_TILE_DIR,
+    help=f"Folder where the tiles are cached. Defaults to {DEFAULT_TILE_DIR}",
+)
+parser.add_argument(
+    "--cache-size",
+    default=CACHE_SIZE,
+    type=int,
+    help=f"Maximum size of the tile cache. Defaults to {CACHE_SIZE} MB",
+)
+parser.add_argument(
+    "--max-layers",
+    default=MAX_LAYERS,
+    type=int,
+    help=f"Maximum number of layers, the oldest are removed. Defaults to {MAX_LAYERS}",
+)
+parser.add_argument(
+    "--store",
+    default="memory",
+    choices=["memory", "sqlite"],
+    help="Where the layers are stored, use sqlite to share them between processes",
+)
+parser.add_argument(
+    "--store-path",
+    default=DEFAULT_SQLITE_PATH,
+    help=f"Database of the sqlite store. Defaults to {DEFAULT_SQLITE_PATH}",
+)
+parser.add_argument(
+    "--upstream-concurrency",
+    default=CONCURRENCY,
+    type=int,
+    help=f"Maximum tile requests in flight to each upstream host. Defaults to {CONCURRENCY}",
+)
+parser.add_argument(
+    "--upstream-rate",
+    default=RATE,
+    type=float,
+    help="Maximum tile requests per second to each upstream host. Defaults to no limit",
+)
+parser.add_argument(
+    "--trace",
+    action="store_true",
+    help="Send a Server-Timing header with every response, not only when asked",
+)
+parser.add_argument(
+    "--project",
+    default=None,
+    help="Google Cloud project used to initialize Earth Engine for server-side jobs",
+)
+
+api = Blueprint("geeservermap", __name__)
+ARCHIVES = TileArchives()
+_EE_LOCK = threading.Lock()
+SHUTDOWN = threading.Event()
+COMPRESSOR = Compressor()
+REQUESTS = METRICS.histogram(
+    "geeservermap_request_seconds",
+    "Duration of the requests handled by the server",
+    labels=("method", "route", "status"),
+)
+PICKUP = METRICS.histogram(
+    "geeservermap_layer_pickup_seconds",
+    "Time between the registration of a layer and its first delivery to a browser",
+)
+PICKUPS = MemoryCache(max_size=MAX_LAYERS)
+"""Seconds each layer waited before being delivered to a browser."""
+SEEDS = Async(max_workers=SEED_JOBS)
+"""Seeding jobs, run apart so they don't hold the workers minting the map ids."""
+PIXELS = MemoryCache(max_size=4096)
+"""Values of the inspected pixels by layer, zoom and pixel."""
+INSPECT_SCALE = 156543.034  # meters per pixel at zoom 0 on the equator
+
+
+class AppState:
+    """Layer stores, tile cache and upstream client of an app.
+
+    The ones that are not given are created with their default settings.
+
+    Args:
+        messages: the layers of the default session
+        sessions: the layers of the named sessions
+        tile_cache: the cache of the tiles fetched upstream
+        upstream: the client fetching the tiles upstream
+        vectors: the features of the vector layers
+    """
+
+    def __init__(
+        self,
+        messages: Optional[BaseRegistry] = None,
+        sessions: Optional[Sessions] = None,
+        tile_cache: Optional[TileCache] = None,
+        upstream: Optional[Upstream] = None,
+        vectors: Optional[VectorStore] = None,
+    ):
+        """Create the missing stores."""
+        self.messages = LayerRegistry() if messages is None else messages
+        self.sessions = Sessions() if sessions is None else sessions
+        self.tile_cache = TileCache() if tile_cache is None else tile_cache
+        self.upstream = Upstream() if upstream is None else upstream
+        self.vectors = VectorStore() if vectors is None else vectors
+
+    def registry(self, session: Optional[str] = None, create=False) -> BaseRegistry:
+        """Get the layer store of a session, None for the default one.
+
+        A session that doesn't exist is created with ``create``, otherwise an
+        empty store that isn't kept is returned for it.
+        """
+        if session is None:
+            return self.messages
+        registry = self.sessions.get(session, create)
+        return LayerRegistry() if registry is None else registry
+
+    def fetch_tile(
+        self, source: str, z: int, x: int, y: int
+    ) -> Tuple[str, Optional[bytes], int]:
+        """Get a tile from the cache, fetching it from upstream if it's not there.
+
+        Args:
+            source: the upstream tiles URL with ``{z}``, ``{x}`` and ``{y}``
+                placeholders
+            z: the zoom of the tile
+            x: the column of the tile
+            y: the row of the tile
+
+        Returns:
+            the cache key and the content of the tile, or None and the upstream
+            status code if it couldn't be fetched
+        """
+        key = TileCache.key(source, z, x, y)
+        with tracing.span("cache"):
+            data = self.tile_cache.get(key)
+        if data is None:
+            with tracing.span("upstream"):
+                status, data = self.upstream.get(source.format(z=z, x=x, y=y))
+            if status != 200 or data is None:
+                return key, None, status
+            self.tile_cache.set(key, data)
+        return key, data, 200
+
+
+@api.url_value_preprocessor
+def pull_session(endpoint, values):
+    """Take the name of the session out of the URL of the session routes."""
+    g.session = values.pop("session", None) if values else None
+    if g.session is not None and not SESSION_NAME.fullmatch(g.session):
+        abort(404)
+
+
+def _session():
+    """Get the name of the session of the request, None for the default one."""
+    return g.get("session")
+
+
+def _state():
+    """Get the stores of the current app."""
+    return current_app.extensions["geeservermap"]
 
-app = Flask(__name__)
 
+def _registry(session=None, create=False):
+    """Get the layer store of a session of the current app, None for the default one.
 
-def register_map(width, height):
-    """Register the index endpoint, allowing the user to pass a height and width."""
+    Only the requests adding to a session ``create`` it.
+    """
+    return _state().registry(session, create)
 
-    @app.route("/")
-    def map():
-        return render_template("map.html", width=width, height=height)
 
+def _prefix(session=None):
+    """Get the prefix of the URLs of a session."""
+    return "" if session is None else f"/s/{session}"
 
-@app.route("/add_layer", methods=["GET"])
+
+@api.before_request
+def start_timer():
+    """Start timing the request, tracing its stages if asked to."""
+    g.start = time.perf_counter()
+    if current_app.config.get("TRACE") or tracing.HEADER in request.headers:
+        tracing.start()
+    else:
+        # a request that failed may have left its trace on the thread
+        tracing.stop()
+
+
+@api.after_request
+def observe(response):
+    """Record the duration of the request, compression included."""
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    duration = time.perf_counter() - g.get("start", time.perf_counter())
+    REQUESTS.observe(duration, request.method, route, response.status_code)
+    trace = tracing.stop()
+    if trace is not None:
+        trace.add("total", duration)
+        response.headers["Server-Timing"] = trace.header()
+    return response
+
+
+@api.errorhandler(TooManySessions)
+def too_many_sessions(error):
+    """Refuse to create a session when the server can't keep one more."""
+    return jsonify({"error": error.message}), 503
+
+
+@api.after_request
+def compress(response):
+    """Compress the JSON and text responses when the client accepts it."""
+    return COMPRESSOR.apply(request, response)
+
+
+def create_app(
+    width=WIDTH, height=HEIGHT, trace=False, workers=1, state=None, project=None
+):
+    """Create the Flask app serving the map and the API of the client.
+
+    Args:
+        width: width of the map's pane in px
+        height: height of the map's pane in px
+        trace: send a ``Server-Timing`` header with every response, otherwise
+            only the requests with the ``X-Geeservermap-Trace`` header get one
+        workers: number of server processes, the jobs are refused with more than
+            one since each process has its own
+        state: the layer stores, tile cache and upstream client of the app, new
+            ones with the default settings by default
+        project: the Google Cloud project used by the jobs to initialize Earth
+            Engine
+
+    Returns:
+        the Flask app
+    """
+    app = Flask(__name__)
+    app.config["MAP_WIDTH"] = width
+    app.config["MAP_HEIGHT"] = height
+    app.config["TRACE"] = trace
+    app.config["WORKERS"] = workers
+    app.config["EE_PROJECT"] = project
+    app.extensions["geeservermap"] = AppState() if state is None else state
+    app.register_blueprint(api)
+    # the same routes scoped to a named session
+    app.register_blueprint(api, url_prefix="/s/<session>", name="session")
+    return app
+
+
+@api.route("/")
+def index():
+    """Render the map of the session."""
+    width, height = current_app.config["MAP_WIDTH"], current_app.config["MAP_HEIGHT"]
+    base = _prefix(_session())
+    return render_template("map.html", width=width, height=height, base=base)
+
+
+@api.route("/add_layer", methods=["GET", "POST"])
 def add_layer():
-    """TODO Missing docstring."""
-    url = request.args.get("url", type=str)
-    name = request.args.get("name", type=str)
-    visible = request.args.get("visible", type=bool)
-    opacity = request.args.get("opacity", type=float)
-    layer = {"url": url, "name": name, "visible": visible, "opacity": opacity}
-    job_id = uuid.uuid4().hex
+    """Register a layer sent as a JSON body or as query parameters."""
+    if request.method == "POST":
+        layer = _layer_from_json(request.get_json(force=True))
+    else:
+        url = request.args.get("url", type=str)
+        name = request.args.get("name", type=str)
+        visible = request.args.get("visible", type=bool)
+        opacity = request.args.get("opacity", type=float)
+        layer = {"url": url, "name": name, "visible": visible, "opacity": opacity}
+    job_id = _register_layer(layer, _session())
     print(job_id)
-    MESSAGES[job_id] = layer
     return jsonify({"job_id": job_id})
 
 
-@app.route("/get_message", methods=["GET"])
+@api.route("/add_layers", methods=["POST"])
+def add_layers():
+    """Register a batch of layers sent as a JSON list in a single request."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, list) or not all(isinstance(p, dict) for p in data):
+        return jsonify({"error": "expected a JSON list of layers"}), 400
+    session = _session()
+    job_ids = [_register_layer(_layer_from_json(p), session) for p in data]
+    return jsonify({"job_ids": job_ids})
+
+
+def _layer_from_json(params):
+    """Build a layer out of the JSON message sent by the client."""
+    layer = {
+        "url": params.get("url"),
+        "name": params.get("name"),
+        "visible": bool(params.get("visible")),
+        "opacity": params.get("opacity"),
+    }
+    if params.get("image"):
+        # the serialized ee.Image of the layer, to inspect its pixels, is kept
+        # on the server, the browser only gets the inspect flag
+        layer["image"] = params["image"]
+        layer["inspect"] = True
+    return layer
+
+
+def _for_browser(layers):
+    """Drop the image expressions, only used by the server, from the layers."""
+    return {
+        layer_id: _browser_layer(layer) if "image" in layer else layer
+        for layer_id, layer in layers.items()
+    }
+
+
+def _browser_layer(layer):
+    """Copy a layer without its image expression."""
+    return {key: value for key, value in layer.items() if key != "image"}
+
+
+def _register_layer(layer, session=None):
+    """Store a new layer and wake up the clients waiting for changes.
+
+    Args:
+        layer: the layer sent by the client, its ``url`` is the upstream tiles URL
+        session: the name of the session of the layer, None for the default one
+
+    Returns:
+        the id of the layer
+    """
+    job_id = uuid.uuid4().hex
+    # the browser fetches the tiles through the local cache
+    if "sources" not in layer:
+        layer["source"] = layer["url"]
+    layer["url"] = f"{_prefix(session)}/tiles/{job_id}/{{z}}/{{x}}/{{y}}"
+    layer["added"] = time.time()
+    return _registry(session, create=True).add(layer, job_id)
+
+
+@api.route("/add_composite", methods=["POST"])
+def add_composite():
+    """Register a layer blending the tiles of several tile layers on the server.
+
+    The JSON body contains the ``layer_ids`` from bottom to top, the ``name``
+    and ``visible`` of the new layer and ``replace`` to remove the stacked
+    layers so the browser fetches a single stream of tiles.
+    """
+    if not composite.available():
+        return jsonify({"error": "pip install geeservermap[composite]"}), 501
+    params = request.get_json(force=True)
+    session = _session()
+    registry = _registry(session)
+    stacked = [registry.get(i) for i in params.get("layer_ids", [])]
+    if not stacked or any(s is None or "source" not in s for s in stacked):
+        return jsonify({"error": "expected the ids of tile layers"}), 400
+    layer = {
+        "url": None,
+        "name": params.get("name"),
+        "visible": bool(params.get("visible", True)),
+        "opacity": 1,
+        "sources": [[s["source"], s.get("opacity")] for s in stacked],
+    }
+    if params.get("replace", True):
+        for layer_id in params["layer_ids"]:
+            registry.remove(layer_id)
+    return jsonify({"job_id": _register_layer(layer, session)})
+
+
+@api.route("/add_vector", methods=["POST"])
+def add_vector():
+    """Register a vector layer whose GeoJSON FeatureCollection is sent as JSON.
+
+    The features are kept on the server, the browser gets them in tiles
+    simplified for the zoom level from the ``/vector`` endpoint.
+    """
+    params = request.get_json(force=True)
+    if "geojson" not in params:
+        return jsonify({"error": "missing geojson"}), 400
+    job_id = uuid.uuid4().hex
+    session = _session()
+    registry = _registry(session, create=True)
+    vectors = _state().vectors
+    vectors.add(job_id, params["geojson"], session)
+    layer = {
+        "type": "vector",
+        "url": f"{_prefix(session)}/vector/{job_id}/{{z}}/{{x}}/{{y}}",
+        "name": params.get("name"),
+        "visible": bool(params.get("visible")),
+        "opacity": params.get("opacity"),
+        "color": params.get("color"),
+        "added": time.time(),
+    }
+    registry.add(layer, job_id)
+    vectors.prune(registry, session=session)
+    return jsonify({"job_id": job_id})
+
+
+@api.route("/add_archive", methods=["POST"])
+def add_archive():
+    """Register a layer served from an MBTiles or PMTiles archive of the server.
+
+    The ``path`` of the archive is a path on the machine running the server.
+    """
+    params = request.get_json(force=True)
+    if "path" not in params:
+        return jsonify({"error": "missing path"}), 400
+    try:
+        archive = ARCHIVES.get(params["path"])
+    except (OSError, ValueError) as error:
+        return jsonify({"error": str(error)}), 400
+    job_id = uuid.uuid4().hex
+    session = _session()
+    layer = {
+        "type": "archive",
+        "url": f"{_prefix(session)}/archive/{job_id}/{{z}}/{{x}}/{{y}}",
+        "path": str(archive.path),
+        "name": params.get("name"),
+        "visible": bool(params.get("visible", True)),
+        "opacity": params.get("opacity", 1),
+        "maxzoom": archive.maxzoom,
+        "added": time.time(),
+    }
+    _registry(session, create=True).add(layer, job_id)
+    return jsonify({"job_id": job_id})
+
+
+@api.route("/archive/<layer_id>/<int:z>/<int:x>/<int:y>")
+def archive_tile(layer_id, z, x, y):
+    """Get a tile of an archive layer."""
+    etag = f"{layer_id}-{z}-{x}-{y}"
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    layer = _registry(_session()).get(layer_id)
+    if layer is None or layer.get("type") != "archive":
+        return Response(status=404)
+    try:
+        archive = ARCHIVES.get(layer["path"])
+    except (OSError, ValueError):
+        return Response(status=404)
+    with tracing.span("archive"):
+        data = archive.tile(z, x, y)
+    if data is None:
+        return Response(status=404)
+    response = Response(data, mimetype=archive.mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    return response
+
+
+@api.route("/vector/<layer_id>/<int:z>/<int:x>/<int:y>")
+def vector_tile(layer_id, z, x, y):
+    """Get the features of a vector layer in a tile, simplified for its zoom."""
+    etag = f"{layer_id}-{z}-{x}-{y}"
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    session = _session()
+    if layer_id in _registry(session):
+        data = _state().vectors.tile(layer_id, z, x, y, session)
+    else:
+        data = None
+    if data is None:
+        return Response(status=404)
+    response = Response(data, mimetype="application/geo+json")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    return response
+
+
+@api.route("/layers/<layer_id>/timing")
+def layer_timing(layer_id):
+    """Get when a layer was added and how long it waited before a browser got it.
+
+    The ``pickup`` is None until a browser got the layer from this process.
+    """
+    layer = _registry(_session()).get(layer_id)
+    if layer is None:
+        return jsonify({"error": f"unknown layer {layer_id}"}), 404
+    return jsonify({"added": layer.get("added"), "pickup": PICKUPS.get(layer_id)})
+
+
+def _delivered(layers):
+    """Record how long the layers sent to a browser waited to be picked up."""
+    now = time.time()
+    for layer_id, layer in layers.items():
+        added = layer.get("added")
+        if added is not None and PICKUPS.get(layer_id) is None:
+            PICKUPS.set(layer_id, now - added)
+            PICKUP.observe(now - added)
+
+
+@api.route("/layers/<layer_id>", methods=["DELETE"])
+def remove_layer(layer_id):
+    """Remove a layer from the map."""
+    session = _session()
+    if not _registry(session).remove(layer_id):
+        return jsonify({"error": f"unknown layer {layer_id}"}), 404
+    _state().vectors.remove(layer_id, session)
+    return jsonify({"removed": 1})
+
+
+@api.route("/viewport", methods=["GET", "POST"])
+def viewport():
+    """Get the viewport of the map, or set it when the browser moves the map.
+
+    The viewport is the region over which the layers added with
+    ``{"stretch": True}`` in their visParams are stretched.
+    """
+    session = _session()
+    registry = _registry(session, create=request.method == "POST")
+    if request.method == "POST":
+        params = request.get_json(force=True)
+        try:
+            west, south, east, north = (float(c) for c in params["bbox"])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "expected a [west, south, east, north] bbox"}), 400
+        bbox = [max(west, -180), max(south, -90), min(east, 180), min(north, 90)]
+        registry.set_viewport({"bbox": bbox, "zoom": params.get("zoom")})
+    viewport = registry.viewport() or {}
+    return jsonify({"bbox": viewport.get("bbox"), "zoom": viewport.get("zoom")})
+
+
+@api.route("/layers/clear", methods=["POST"])
+def clear_layers():
+    """Remove all the layers from the map."""
+    session = _session()
+    registry = _registry(session)
+    removed = registry.clear()
+    _state().vectors.prune(registry, grace=0, session=session)
+    return jsonify({"removed": removed})
+
+
+@api.route("/get_message", methods=["GET"])
 def get_message():
     """TODO Missing docstring."""
     job_id = request.args.get("id", type=str)
-    return MESSAGES.get(job_id)
+    layer = _registry(_session()).get(job_id)
+    return None if layer is None else _browser_layer(layer)
 
 
-@app.route("/messages")
+@api.route("/messages")
 def messages():
-    """TODO Missing docstring."""
-    return jsonify(MESSAGES)
+    """Get the registered layers, optionally only the changes newer than ``since``.
+
+    With ``since``, the removed layers are sent as tombstones and the
+    ``X-Layers-Reset`` header tells the client to drop the layers that are not
+    in the response because the changes it missed are not known anymore.
+
+    The response carries an ETag built from the last sequence number so that an
+    unchanged state is answered with an empty 304.
+    """
+    since = request.args.get("since", default=0, type=int)
+    registry = _registry(_session())
+    etag = str(registry.seq)
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    if since:
+        changes, reset = registry.changes(since)
+        _delivered(changes)
+        response = jsonify(_for_browser(changes))
+        if reset:
+            response.headers["X-Layers-Reset"] = "1"
+    else:
+        layers = registry.layers()
+        _delivered(layers)
+        response = jsonify(_for_browser(layers))
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@api.route("/events")
+def events():
+    """Stream the layer changes to the browser as Server-Sent Events.
+
+    Each change is sent as a ``layer`` event whose id is its sequence number so
+    a reconnecting ``EventSource`` resumes from the ``Last-Event-ID`` it sends
+    back. If the changes since then are not known anymore, a ``reset`` event
+    with all the layers is sent instead, as when the ``Last-Event-ID`` is ahead of
+    the store because the server restarted. A comment is sent every ``HEARTBEAT``
+    seconds to keep the connection alive.
+
+    The stream of a session that doesn't exist yet waits for its first layer.
+    If the session is closed meanwhile, the stream sends a reset once it's
+    opened again.
+    """
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_id")
+    try:
+        seq = int(last_id or 0)
+    except ValueError:
+        seq = 0
+    session, state = _session(), _state()
+
+    def opened():
+        return state.messages if session is None else state.sessions.get(session)
+
+    def stream(seq):
+        yield "retry: 2000\n\n"
+        registry = opened()
+        # the streams are closed when the server shuts down so it can drain
+        while not SHUTDOWN.is_set():
+            if registry is None:
+                registry = state.sessions.wait(session, timeout=HEARTBEAT)
+                if registry is None:
+                    yield ": heartbeat\n\n"
+                    continue
+                # the cursor isn't from this store, so all the layers are sent
+                seq = -1
+            # waiting for a cursor ahead of the store would never end
+            if seq <= registry.seq and not registry.wait(seq, timeout=HEARTBEAT):
+                yield ": heartbeat\n\n"
+                current = opened()
+                if current is not registry:
+                    registry, seq = current, -1
+                continue
+            last = registry.seq
+            changes, reset = registry.changes(seq)
+            _delivered(changes)
+            changes = _for_browser(changes)
+            if reset:
+                data = json.dumps(changes)
+                yield f"id: {last}\nevent: reset\ndata: {data}\n\n"
+                seq = last
+                continue
+            for job_id, layer in changes.items():
+                seq = layer["seq"]
+                data = json.dumps({job_id: layer})
+                yield f"id: {seq}\nevent: layer\ndata: {data}\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream(seq), mimetype="text/event-stream", headers=headers)
+
+
+def _single_worker(view):
+    """Refuse the requests of a view using the jobs when there are several workers.
+
+    The jobs are kept by the process running them, so the next request about
+    a job may reach a process that doesn't know it.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_app.config.get("WORKERS", 1) > 1:
+            error = "the jobs need a server with a single worker (--workers 1)"
+            return jsonify({"error": error}), 501
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@api.route("/jobs", methods=["POST"])
+@_single_worker
+def add_job():
+    """Mint the map id of a serialized ``ee.Image`` in the background.
+
+    The JSON body contains the ``image`` expression, its ``visParams`` and the
+    ``name``, ``shown`` and ``opacity`` of the layer. The job id is returned
+    right away and the layer is registered once its map id is ready.
+    """
+    params = request.get_json(force=True)
+    if "image" not in params:
+        return jsonify({"error": "missing image expression"}), 400
+    params["session"] = _session()
+    app = current_app._get_current_object()
+    try:
+        job = asyncgee.submit(_mint_layer, app, params)
+    except TooManyJobs as e:
+        return jsonify({"error": e.message}), 503
+    return jsonify({"job_id": job["id"]})
+
+
+@api.route("/jobs/<job_id>")
+@_single_worker
+def get_job(job_id):
+    """Get the state of a job and its result once it is finished."""
+    job = asyncgee.get_job_result(job_id) or SEEDS.get_job_result(job_id)
+    if job is None:
+        return jsonify({"error": f"unknown job {job_id}"}), 404
+    return jsonify(job)
+
+
+@api.route("/jobs/<job_id>", methods=["DELETE"])
+@_single_worker
+def cancel_job(job_id):
+    """Ask a job to stop, it ends in the ``cancelled`` state."""
+    if not (asyncgee.cancel(job_id) or SEEDS.cancel(job_id)):
+        return jsonify({"error": f"no running job {job_id}"}), 404
+    return jsonify({"cancelled": True})
+
+
+@api.route("/seed", methods=["POST"])
+@_single_worker
+def seed():
+    """Fill the tile cache of a layer for a bounding box and a range of zooms.
+
+    The JSON body contains the ``layer_id``, the ``bbox`` as ``[west, south,
+    east, north]`` and the ``zooms`` as ``[min, max]``. The tiles are fetched
+    by a job whose ``progress`` is reported by ``/jobs/<id>`` and which can be
+    cancelled with ``DELETE /jobs/<id>``. Only ``SEED_JOBS`` seeding jobs run at
+    the same time, apart from the jobs minting map ids.
+    """
+    params = request.get_json(force=True)
+    layer = _registry(_session()).get(params.get("layer_id"))
+    if layer is None or "source" not in layer:
+        return jsonify({"error": "unknown tile layer"}), 404
+    try:
+        bbox = [float(c) for c in params["bbox"]]
+        zmin, zmax = (int(z) for z in params["zooms"])
+        if len(bbox) != 4 or not 0 <= zmin <= zmax <= MAX_SEED_ZOOM:
+            raise ValueError("bbox or zooms out of range")
+        ranges = [(z, *tile_range(bbox, z)) for z in range(zmin, zmax + 1)]
+    except (KeyError, TypeError, ValueError, OverflowError):
+        error = "expected a [west, south, east, north] bbox and [min, max] zooms"
+        return jsonify({"error": f"{error} up to {MAX_SEED_ZOOM}"}), 400
+    total = sum((x1 - x0 + 1) * (y1 - y0 + 1) for _, x0, y0, x1, y1 in ranges)
+    if total > MAX_SEED_TILES:
+        return jsonify({"error": f"{total} tiles, the limit is {MAX_SEED_TILES}"}), 400
+    try:
+        job = SEEDS.submit(_seed, _state(), layer["source"], ranges, total, track=True)
+    except TooManyJobs as e:
+        return jsonify({"error": e.message}), 503
+    return jsonify({"job_id": job["id"], "tiles": total})
+
+
+def _seed(job, state, source, ranges, total):
+    """Fetch the tiles of ``ranges`` in a pool of threads, reporting the progress.
+
+    Args:
+        job: the job running the seeding
+        state: the stores of the app, with the tile cache to fill
+        source: the upstream tiles URL of the layer
+        ranges: ``(z, xmin, ymin, xmax, ymax)`` of each zoom level
+        total: the number of tiles to fetch
+
+    Returns:
+        the progress of the job
+    """
+    progress = job["progress"] = {"total": total, "done": 0, "failed": 0}
+    tiles = (
+        (z, x, y)
+        for z, xmin, ymin, xmax, ymax in ranges
+        for x in range(xmin, xmax + 1)
+        for y in range(ymin, ymax + 1)
+    )
+
+    def fetch(tile):
+        return state.fetch_tile(source, *tile)[1] is not None
+
+    with ThreadPoolExecutor(SEED_WORKERS) as pool:
+        # a few batches in flight so a cancellation is noticed quickly
+        while not job["cancelled"]:
+            batch = list(itertools.islice(tiles, SEED_WORKERS * 4))
+            if not batch:
+                break
+            for ok in pool.map(fetch, batch):
+                progress["done"] += 1
+                progress["failed"] += not ok
+    return progress
+
+
+def _mint_layer(app, params):
+    """Compute the visParams and the map id of an image and register its layer.
+
+    Args:
+        app: the app the layer is registered in
+        params: the JSON message sent to the ``/jobs`` endpoint
+
+    Returns:
+        the id of the registered layer
+    """
+    # the job runs in a thread of the job store, out of the request
+    with app.app_context():
+        return _mint(params)
+
+
+def _mint(params):
+    """Mint the map id of a ``/jobs`` message in the context of its app."""
+    _initialize_ee()
+    image = ee.Image(ee.deserializer.fromJSON(params["image"]))
+    session = params.get("session")
+    vis = dict(params.get("visParams") or {})
+    if vis.get("stretch") is True:
+        vis["stretch"] = (_registry(session).viewport() or {}).get("bbox")
+    vis = layers.VisParams.from_image(image, vis)
+    image = layers.Image(image, vis, cache=params.get("cache", True))
+    layer = image.layer(params.get("opacity", 1), params.get("shown", True))
+    data = layer.info()
+    data["name"] = params.get("name")
+    data["image"] = params["image"]
+    return {"layer_id": _register_layer(_layer_from_json(data), session)}
+
+
+def _initialize_ee():
+    """Initialize Earth Engine for the requests made by the server itself."""
+    with _EE_LOCK:
+        if not ee.data.is_initialized():
+            ee.Initialize(project=current_app.config.get("EE_PROJECT"))
+
+
+@api.route("/inspect", methods=["POST"])
+def inspect():
+    """Get the values of the pixel under a point in the image layers.
+
+    The JSON body has the ``lon``, ``lat`` and ``zoom`` of the point and the
+    ``layer_ids`` to inspect, all the image layers by default. The pixels are
+    cached by layer, zoom and pixel, the ones not cached are sampled at the
+    scale of the zoom in a single Earth Engine request.
+
+    Returns:
+        the ``name`` and the ``values`` of the bands of each layer
+    """
+    params = request.get_json(force=True)
+    try:
+        lon, lat = float(params["lon"]), float(params["lat"])
+        zoom = int(params["zoom"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "lon, lat and zoom are required"}), 400
+    registry = _registry(_session())
+    layer_ids = params.get("layer_ids")
+    if layer_ids is None:
+        inspected = registry.layers()
+    else:
+        inspected = {i: registry.get(i) for i in layer_ids}
+    inspected = {
+        layer_id: layer
+        for layer_id, layer in inspected.items()
+        if layer and layer.get("image")
+    }
+    # the pixel of the 256 px tiles at this zoom
+    x, y, _, _ = tile_range([lon, lat, lon, lat], zoom + 8)
+    values, missing = {}, {}
+    for layer_id, layer in inspected.items():
+        cached = PIXELS.get((layer_id, zoom, x, y))
+        if cached is None:
+            missing[layer_id] = layer["image"]
+        else:
+            values[layer_id] = cached
+    if missing:
+        try:
+            with tracing.span("inspect"):
+                sampled = _sample(missing, lon, lat, zoom)
+        except ee.EEException as error:
+            return jsonify({"error": str(error)}), 502
+        for layer_id, pixel in sampled.items():
+            PIXELS.set((layer_id, zoom, x, y), pixel)
+        values.update(sampled)
+    result = {
+        layer_id: {"name": layer.get("name"), "values": values.get(layer_id)}
+        for layer_id, layer in inspected.items()
+    }
+    return jsonify({"layers": result})
+
+
+def _sample(images, lon, lat, zoom):
+    """Get the values of the pixel under a point in several images at once.
+
+    Args:
+        images: the serialized images by layer id
+        lon: the longitude of the point
+        lat: the latitude of the point
+        zoom: the zoom giving the scale of the pixel
+
+    Returns:
+        the values of the bands of each image by layer id
+    """
+    _initialize_ee()
+    point = ee.Geometry.Point([lon, lat])
+    scale = INSPECT_SCALE / 2**zoom * math.cos(math.radians(lat))
+    samples = {
+        layer_id: ee.Image(ee.deserializer.fromJSON(image)).reduceRegion(
+            ee.Reducer.first(), point, scale
+        )
+        for layer_id, image in images.items()
+    }
+    with EE_CALLS.time("inspect"):
+        return ee.Dictionary(samples).getInfo()
+
+
+@api.route("/tiles/<layer_id>/<int:z>/<int:x>/<int:y>")
+def tile(layer_id, z, x, y):
+    """Proxy a tile of a registered layer, serving it from the cache if possible."""
+    layer = _registry(_session()).get(layer_id)
+    if layer is not None and "sources" in layer:
+        return _composite_tile(layer["sources"], z, x, y)
+    if layer is None or "source" not in layer:
+        return Response(status=404)
+    source = layer["source"]
+    key = TileCache.key(source, z, x, y)
+    if request.if_none_match.contains_weak(key):
+        return Response(status=304, headers={"ETag": f'"{key}"'})
+    key, data, status = _state().fetch_tile(source, z, x, y)
+    if data is None:
+        return Response(status=status)
+    return _tile_response(key, data)
+
+
+def _tile_response(key, data):
+    """Build the response of a tile the browser can reuse without asking again."""
+    response = Response(data, mimetype=_tile_mimetype(data))
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    return response
+
+
+def _composite_tile(sources, z, x, y):
+    """Blend the tiles of stacked layers, fetched in parallel, into a single tile.
+
+    The result is WebP if the browser accepts it, PNG otherwise, and is cached
+    like the tiles of the stacked layers.
+
+    Args:
+        sources: the upstream tiles URL and opacity of each layer, bottom first
+        z: the zoom of the tile
+        x: the column of the tile
+        y: the row of the tile
+    """
+    webp = request.accept_mimetypes["image/webp"] > 0
+    format = "webp" if webp else "png"
+    key = TileCache.key("composite", format, json.dumps(sources), z, x, y)
+    if request.if_none_match.contains_weak(key):
+        return Response(status=304, headers={"ETag": f'"{key}"'})
+    state = _state()
+    data = state.tile_cache.get(key)
+    if data is None:
+        with ThreadPoolExecutor(len(sources)) as pool:
+            fetched = list(pool.map(lambda s: state.fetch_tile(s[0], z, x, y), sources))
+        statuses = [status for _, _, status in fetched]
+        if all(d is None for _, d, _ in fetched):
+            return Response(status=next((s for s in statuses if s != 404), 404))
+        tiles = [(d, opacity) for (_, d, _), (_, opacity) in zip(fetched, sources)]
+        with tracing.span("blend"):
+            data = composite.blend(tiles, format)
+        if any(status not in (200, 404) for status in statuses):
+            # a layer failed upstream, the blend without it must not be reused
+            response = Response(data, mimetype=_tile_mimetype(data))
+            response.cache_control.no_store = True
+            response.vary.add("Accept")
+            return response
+        state.tile_cache.set(key, data)
+    response = _tile_response(key, data)
+    response.vary.add("Accept")
+    return response
+
+
+def _tile_mimetype(data):
+    """Guess the mimetype of a tile from its first bytes."""
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+def _cache_stats():
+    """Get the ``(hits, misses)`` of each cache of the process."""
+    state = _state()
+    tiles = state.tile_cache.stats()
+    hits, misses = tiles["hits"], tiles["misses"]
+    stats = {
+        "tiles": (hits["memory"] + hits["disk"], misses),
+        "tiles_memory": (hits["memory"], hits["disk"] + misses),
+    }
+    memory_caches = {
+        "mapids": layers.MAPID_CACHE,
+        "bands": helpers.BANDS_CACHE,
+        "vector_tiles": state.vectors.tiles,
+        "compressed": COMPRESSOR.cache,
+        "pixels": PIXELS,
+    }
+    for name, cache in memory_caches.items():
+        stats[name] = (cache.hits, cache.misses)
+    return stats
+
+
+def _hit_ratios():
+    """Get the hit ratio of each cache, 0 if it wasn't used yet."""
+    return {k: h / (h + m) if h + m else 0 for k, (h, m) in _cache_stats().items()}
+
+
+def _job_stats():
+    """Count the jobs of each state of both job stores and get the oldest age."""
+    stats = [asyncgee.stats(), SEEDS.stats()]
+    states = {}
+    for stat in stats:
+        for state, count in stat["states"].items():
+            states[state] = states.get(state, 0) + count
+    return {"states": states, "oldest": max(stat["oldest"] for stat in stats)}
+
+
+METRICS.gauge(
+    "geeservermap_layers",
+    "Number of layers registered",
+    lambda: len(_state().messages),
+)
+METRICS.gauge(
+    "geeservermap_sessions",
+    "Number of sessions open",
+    lambda: len(_state().sessions),
+)
+METRICS.gauge(
+    "geeservermap_upstream_total",
+    "Tile fetches sent upstream, coalesced with a fetch in flight and retried",
+    lambda: _state().upstream.stats,
+    label="kind",
+    type="counter",
+)
+METRICS.gauge(
+    "geeservermap_jobs",
+    "Number of jobs in the store by state",
+    lambda: _job_stats()["states"],
+    label="state",
+)
+METRICS.gauge(
+    "geeservermap_jobs_oldest_seconds",
+    "Age of the oldest job not finished yet",
+    lambda: _job_stats()["oldest"],
+)
+METRICS.gauge(
+    "geeservermap_cache_hits_total",
+    "Number of hits of each cache",
+    lambda: {k: h for k, (h, _) in _cache_stats().items()},
+    label="cache",
+    type="counter",
+)
+METRICS.gauge(
+    "geeservermap_cache_misses_total",
+    "Number of misses of each cache",
+    lambda: {k: m for k, (_, m) in _cache_stats().items()},
+    label="cache",
+    type="counter",
+)
+METRICS.gauge(
+    "geeservermap_cache_hit_ratio",
+    "Ratio of the lookups of each cache that were hits",
+    _hit_ratios,
+    label="cache",
+)
+
+
+@api.route("/metrics")
+def metrics():
+    """Expose the metrics of the process in the Prometheus text format.
+
+    With several workers, each process has its own metrics and answers for
+    itself only.
+    """
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+@api.route("/tiles/stats")
+def tile_stats():
+    """Get the hit/miss counters of the tile cache."""
+    return jsonify(_state().tile_cache.stats())
 
 
 def run():
-    """TODO Missing docstring."""
+    """Run the server from the command line arguments."""
     args = parser.parse_args()
     port = args.port
-    register_map(width=args.width, height=args.height)
+    if args.workers > 1 and args.store == "memory":
+        print("Several workers can't share the memory store, using the sqlite one")
+        args.store = "sqlite"
+    state = AppState(
+        messages=open_registry(args.store, args.store_path, args.max_layers),
+        sessions=Sessions(args.store, args.store_path, args.max_layers),
+        tile_cache=TileCache(args.cache_dir, args.cache_size * 2**20),
+        upstream=Upstream(args.upstream_concurrency, args.upstream_rate),
+    )
+    if args.workers > 1:
+        print("Several workers don't share their jobs, /jobs and /seed are disabled")
+    app = create_app(
+        args.width, args.height, args.trace, args.workers, state, args.project
+    )
     # webbrowser.open(f'http://localhost:{port}')
-    app.run(debug=True, port=port)
+    if args.debug:
+        app.run(debug=True, host=args.host, port=port)
+    else:
+        serve(app, args.host, port, args.workers, args.threads, SHUTDOWN.set)
@@ -1,35 +1,322 @@
 # coding=utf-8
 """TODO Missing docstring."""
 
+import cProfile
+import heapq
+import itertools
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import ee
 import requests
 
+from . import tracing
 from .elements import layers
-from .exceptions import ServerNotRunning
-from .main import PORT
+from .transport import PORT, Transport
+
+MAX_WORKERS = 8
+MAX_TIMINGS = 100  # timing reports kept by a traced Map
 
 
 class Map:
     """TODO Missing docstring."""
 
-    def __init__(self, port=PORT, do_async=False):
-        """TODO Missing docstring."""
+    def __init__(
+        self,
+        port=PORT,
+        do_async=False,
+        cache=True,
+        trace=False,
+        profile=0,
+        session=None,
+        **transport,
+    ):
+        """Create a client of the server running on ``port``.
+
+        Args:
+            port: the port of the server
+            do_async: send the image expressions to the server, which computes
+                the map ids in the background, instead of waiting for them
+            cache: reuse the map ids already minted for the same image and visParams
+            trace: time the stages of each ``addLayer`` call, see ``report``
+            profile: keep the cProfile stats of this number of slowest
+                ``addLayer`` calls, see ``dump_profiles``
+            session: the name of the session the layers are added to, shown at
+                ``/s/<session>``, None for the default session shown at ``/``
+            transport: ``timeout``, ``retries`` and ``backoff`` of the requests
+                sent to the server, see :class:`geeservermap.transport.Transport`
+        """
         self.port = port
+        self.session = session
         self.do_async = do_async
+        self.cache = cache
+        self.transport = Transport(port, session=session, **transport)
+        self.trace = trace
+        self.profile = profile
+        self.timings: deque = deque(maxlen=MAX_TIMINGS)
+        self._profiles: list = []  # heap of (duration, n, profile), fastest first
+        self._counter = itertools.count()
 
-    def _addImage(self, image, visParams=None, name=None, shown=True, opacity=1):
-        """Add Image Layer to map."""
+    def viewport(self):
+        """Get the ``[west, south, east, north]`` bounds shown by the map, if open."""
+        return self.transport.get("/viewport")["bbox"]
+
+    def _imageLayer(self, image, visParams=None, name=None, shown=True, opacity=1):
+        """Get the message describing an Image Layer, minting its map id.
+
+        With ``{"stretch": True}`` in the visParams, the min and max are
+        computed over the viewport of the map, see ``VisParams.from_image``.
+        """
+        visParams = dict(visParams or {})
+        if visParams.get("stretch") is True:
+            visParams["stretch"] = self.viewport()
+            if visParams["stretch"] is None:
+                print("The map is not open, can't stretch over its viewport")
         vis = layers.VisParams.from_image(image, visParams)
-        image = layers.Image(image, vis)
-        layer = image.layer(opacity, shown)
+        layer = layers.Image(image, vis, cache=self.cache).layer(opacity, shown)
         data = layer.info()
         data["name"] = name
-        try:
-            requests.get(f"http://localhost:{self.port}/add_layer", params=data)
-        except ConnectionError:
-            raise ServerNotRunning(self.port)
+        data["image"] = image.serialize()  # to inspect its pixels on the map
+        return data
+
+    def _addImage(self, image, visParams=None, name=None, shown=True, opacity=1):
+        """Add Image Layer to map.
+
+        In async mode, the id of the server job minting the layer is returned.
+        """
+        if self.do_async:
+            data = {
+                "image": image.serialize(),
+                "visParams": visParams,
+                "name": name,
+                "shown": shown,
+                "opacity": opacity,
+                "cache": self.cache,
+            }
+            return self.transport.post("/jobs", data)["job_id"]
+        data = self._imageLayer(image, visParams, name, shown, opacity)
+        return self.transport.post("/add_layer", data)["job_id"]
+
+    def _addVector(self, vector, visParams=None, name=None, shown=True, opacity=1):
+        """Add Geometry, Feature or FeatureCollection Layer to map.
+
+        The ``color`` of the features can be set in ``visParams``.
+        """
+        color = (visParams or {}).get("color", layers.VectorLayer.COLOR)
+        layer = layers.Geometry(vector).layer(opacity, shown, color)
+        data = layer.info()
+        data["name"] = name
+        return self.transport.post("/add_vector", data)["job_id"]
+
+    def addTileArchive(self, path, name=None, shown=True, opacity=1):
+        """Add a layer served from an MBTiles or PMTiles archive of images.
+
+        The tiles are read from the file by the server, without Earth Engine.
+
+        Args:
+            path: the path of the ``.mbtiles`` or ``.pmtiles`` file, on the
+                machine running the server
+            name: the name of the layer, the name of the file by default
+            shown: whether the layer is shown
+            opacity: the opacity of the layer
+
+        Returns:
+            the id of the layer
+        """
+        path = Path(path).resolve()
+        data = {
+            "path": str(path),
+            "name": name or path.stem,
+            "visible": shown,
+            "opacity": opacity,
+        }
+        return self.transport.post("/add_archive", data)["job_id"]
 
     def addLayer(self, layer, visParas=None, name=None, shown=True, opacity=1):
         """Add a layer to the Map."""
+        args = (layer, visParas, name, shown, opacity)
+        if self.trace or self.profile:
+            return self._traced(self._addLayer, *args)
+        return self._addLayer(*args)
+
+    def _traced(self, func, *args):
+        """Call ``func`` recording the duration of its stages and profiling it."""
+        profile = cProfile.Profile() if self.profile else None
+        trace = tracing.start()
+        begin = time.perf_counter()
+        try:
+            if profile is not None:
+                profile.enable()
+            result = func(*args)
+        finally:
+            if profile is not None:
+                profile.disable()
+            tracing.stop()
+        duration = time.perf_counter() - begin
+        if self.trace:
+            stages = trace.report()
+            self.timings.append(
+                {"layer_id": result, "total": duration * 1000, "stages": stages}
+            )
+        if profile is not None:
+            entry = (duration, next(self._counter), profile)
+            if len(self._profiles) < self.profile:
+                heapq.heappush(self._profiles, entry)
+            else:
+                heapq.heappushpop(self._profiles, entry)
+        return result
+
+    def report(self):
+        """Get the timing of the last ``addLayer`` calls, when tracing.
+
+        Each report contains the ``layer_id``, the ``total`` duration and the
+        duration of each of its ``stages`` in ms: ``bandsInfo``, ``getMapId``,
+        the ``http`` request and the ``server.*`` stages. The ``pickup`` is the
+        time in ms the layer waited for a browser, None until it got it.
+
+        Returns:
+            the reports, oldest first
+        """
+        for timing in self.timings:
+            if timing.get("pickup") is None and timing["layer_id"] is not None:
+                try:
+                    info = self.transport.get(f"/layers/{timing['layer_id']}/timing")
+                except requests.exceptions.HTTPError:
+                    continue  # the layer was removed
+                if info["pickup"] is not None:
+                    timing["pickup"] = info["pickup"] * 1000
+        return list(self.timings)
+
+    def dump_profiles(self, directory):
+        """Write the cProfile stats of the slowest ``addLayer`` calls.
+
+        The files can be read with ``pstats`` or ``snakeviz``.
+
+        Args:
+            directory: the folder where the ``.prof`` files are written
+
+        Returns:
+            the paths of the files, slowest call first
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for rank, (duration, _, profile) in enumerate(sorted(self._profiles)[::-1]):
+            path = directory / f"addLayer-{rank}-{duration * 1000:.0f}ms.prof"
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def _addLayer(self, layer, visParas=None, name=None, shown=True, opacity=1):
+        """Add an Image, Geometry, Feature or FeatureCollection layer."""
         if isinstance(layer, ee.Image):
-            self._addImage(layer, visParas, name, shown, opacity)
+            return self._addImage(layer, visParas, name, shown, opacity)
+        if isinstance(layer, (ee.Geometry, ee.Feature, ee.FeatureCollection)):
+            return self._addVector(layer, visParas, name, shown, opacity)
+
+    def removeLayer(self, layer_id):
+        """Remove a layer from the Map.
+
+        Args:
+            layer_id: the id returned when the layer was added
+        """
+        self.transport.delete(f"/layers/{layer_id}")
+
+    def composite(self, layer_ids, name="composite", shown=True, replace=True):
+        """Blend stacked layers on the server so the browser loads a single layer.
+
+        Needs the ``composite`` extra on the server side.
+
+        Args:
+            layer_ids: the ids of the layers to blend, from bottom to top
+            name: the name of the blended layer
+            shown: whether the blended layer is shown
+            replace: remove the stacked layers from the Map
+
+        Returns:
+            the id of the blended layer
+        """
+        data = {
+            "layer_ids": list(layer_ids),
+            "name": name,
+            "visible": shown,
+            "replace": replace,
+        }
+        return self.transport.post("/add_composite", data)["job_id"]
+
+    def clear(self):
+        """Remove all the layers from the Map and return how many were removed."""
+        return self.transport.post("/layers/clear")["removed"]
+
+    def job(self, job_id):
+        """Get the state of a server job, with its ``result`` once finished."""
+        return self.transport.get(f"/jobs/{job_id}")
+
+    def cancel(self, job_id):
+        """Ask a server job to stop."""
+        self.transport.delete(f"/jobs/{job_id}")
+
+    def seed(self, layer, bbox, zooms):
+        """Warm the server's tile cache of a layer for a region.
+
+        The tiles are fetched by a server job, follow its ``progress`` with
+        ``job`` and stop it with ``cancel``.
+
+        Args:
+            layer: the id returned when the layer was added
+            bbox: the region as ``[west, south, east, north]`` in degrees
+            zooms: the ``[min, max]`` zoom levels to fetch
+
+        Returns:
+            the id of the job
+        """
+        data = {"layer_id": layer, "bbox": list(bbox), "zooms": list(zooms)}
+        return self.transport.post("/seed", data)["job_id"]
+
+    def addLayers(self, layer_list, max_workers=MAX_WORKERS):
+        """Add several layers to the Map at once.
+
+        The visParams and the map ids of the layers are computed concurrently
+        and all the layers are then registered in a single request, so adding
+        a batch takes about as long as adding its slowest layer. A layer that
+        fails doesn't prevent the others from being added.
+
+        Args:
+            layer_list: the layers to add, each one is a dict of the ``addLayer``
+                arguments (``layer``, ``visParams``, ``name``, ``shown`` and
+                ``opacity``) or an ``ee.Image``
+            max_workers: maximum number of layers computed at the same time
+
+        Returns:
+            for each layer, a dict with its ``job_id`` or the ``error`` that
+            prevented it from being added
+        """
+
+        def build(args):
+            if not isinstance(args, dict):
+                args = {"layer": args}
+            args = dict(args)
+            layer = args.pop("layer")
+            if not isinstance(layer, ee.Image):
+                raise TypeError(f"Can't add a layer of type {type(layer).__name__}")
+            return self._imageLayer(layer, **args)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(build, args) for args in layer_list]
+
+        results, data = [], []
+        for future in futures:
+            try:
+                data.append(future.result())
+                results.append({})
+            except Exception as e:
+                results.append({"error": str(e)})
+
+        if data:
+            job_ids = iter(self.transport.post("/add_layers", data)["job_ids"])
+            for result in results:
+                if "error" not in result:
+                    result["job_id"] = next(job_ids)
+        return results
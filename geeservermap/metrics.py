@@ -0,0 +1,151 @@
+"""Metrics exposed in the Prometheus text format by the ``/metrics`` endpoint.
+
+The histograms are updated on the hot path with a lock and a bisect, the
+gauges are computed by callbacks only when the metrics are scraped. Each
+server process has its own metrics.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple) -> str:
+    """Format the labels of a sample, e.g. ``{route="/",method="GET"}``."""
+    if not names:
+        return ""
+    pairs = (f'{n}="{v!s}"' for n, v in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Histogram:
+    """Distribution of durations, with a count and a sum, for each set of labels.
+
+    Args:
+        name: the name of the metric
+        help: the description of the metric
+        labels: the names of the labels
+        buckets: the upper bounds of the buckets in seconds
+    """
+
+    def __init__(self, name: str, help: str, labels=(), buckets=BUCKETS):
+        """Initialize a histogram without samples."""
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        """Record a duration of ``value`` seconds for the ``labels`` values."""
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0, 0.0]
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += 1
+            series[2] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Record the duration of the ``with`` block, even if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels) -> int:
+        """Number of durations recorded for the ``labels`` values."""
+        series = self._series.get(labels)
+        return 0 if series is None else series[1]
+
+    def render(self) -> str:
+        """Format the histogram in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: (list(b), c, s) for k, (b, c, s) in self._series.items()}
+        names = (*self.labels, "le")
+        for values, (buckets, count, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                labels = _labels(names, (*values, bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(names, (*values, "+Inf"))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _labels(self.labels, values)
+            lines.append(f"{self.name}_count{labels} {count}")
+            lines.append(f"{self.name}_sum{labels} {total}")
+        return "\n".join(lines)
+
+
+class Gauge:
+    """Value computed when the metrics are scraped.
+
+    Args:
+        name: the name of the metric
+        help: the description of the metric
+        callback: returns the value, or a dict of the value of each label value
+        label: the name of the label when ``callback`` returns a dict
+        type: ``gauge`` or ``counter`` for a value that only increases
+    """
+
+    def __init__(
+        self, name: str, help: str, callback: Callable, label=None, type="gauge"
+    ):
+        """Initialize the gauge."""
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.label = label
+        self.type = type
+
+    def render(self) -> str:
+        """Format the gauge in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        value = self.callback()
+        if self.label is None:
+            lines.append(f"{self.name} {value}")
+        else:
+            for key, v in value.items():
+                lines.append(f"{self.name}{_labels((self.label,), (key,))} {v}")
+        return "\n".join(lines)
+
+
+class Metrics:
+    """Registry of the metrics of a process."""
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._metrics: dict = {}
+
+    def histogram(self, name: str, help: str, labels=(), buckets=BUCKETS) -> Histogram:
+        """Get the histogram ``name``, creating it the first time."""
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(name, help, labels, buckets)
+        return self._metrics[name]
+
+    def gauge(self, name: str, help: str, callback: Callable, label=None, type="gauge"):
+        """Register a gauge, replacing the one with the same name."""
+        self._metrics[name] = Gauge(name, help, callback, label, type)
+
+    def render(self) -> str:
+        """Format all the metrics in the Prometheus text format."""
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+METRICS = Metrics()
+
+EE_CALLS = METRICS.histogram(
+    "geeservermap_ee_call_seconds",
+    "Duration of the calls to Earth Engine",
+    labels=("call",),
+)
@@ -0,0 +1,571 @@
+"""Registry of the layers displayed on the map."""
+
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+from .exceptions import TooManySessions
+
+MAX_LAYERS = 1000
+MAX_SESSIONS = 256
+SESSION_NAME = re.compile(r"[A-Za-z0-9_-]{1,64}")
+DEFAULT_SQLITE_PATH = Path(tempfile.gettempdir()) / "geeservermap" / "layers.db"
+
+
+class BaseRegistry(ABC):
+    """Interface of the layer stores, ordered by a monotonic sequence number.
+
+    Every change (a new layer or a removed one) gets the next sequence number so
+    the clients can ask for the changes since the last one they know. A removed
+    layer is reported as a ``{"seq": n, "removed": True}`` tombstone. Only the
+    last ``max_size`` tombstones are kept: a client asking for changes older
+    than that is told to reset its state.
+
+    When the registry is full, the oldest layers are evicted.
+    """
+
+    max_size: int
+
+    @property
+    @abstractmethod
+    def seq(self) -> int:
+        """Sequence number of the last change."""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of layers in the registry."""
+
+    def __contains__(self, layer_id: str) -> bool:
+        """Check if a layer is in the registry."""
+        return self.get(layer_id) is not None
+
+    def __getitem__(self, layer_id: str) -> dict:
+        """Get a layer from the registry."""
+        layer = self.get(layer_id)
+        if layer is None:
+            raise KeyError(layer_id)
+        return layer
+
+    @abstractmethod
+    def get(self, layer_id: str, default=None) -> Optional[dict]:
+        """Get a layer from the registry or ``default`` if it's not there."""
+
+    @abstractmethod
+    def layers(self) -> dict:
+        """Get a copy of all the layers, oldest first."""
+
+    @abstractmethod
+    def add(self, layer: dict, layer_id: Optional[str] = None) -> str:
+        """Add a layer, evicting the oldest ones if the registry is full.
+
+        Args:
+            layer: the layer to add, its ``seq`` is set by the registry
+            layer_id: the id of the layer, a random one is created by default
+
+        Returns:
+            the id of the layer
+        """
+
+    @abstractmethod
+    def remove(self, layer_id: str) -> bool:
+        """Remove a layer.
+
+        Args:
+            layer_id: the id of the layer
+
+        Returns:
+            True if the layer was in the registry
+        """
+
+    @abstractmethod
+    def clear(self) -> int:
+        """Remove all the layers and return how many were removed."""
+
+    @abstractmethod
+    def changes(self, since: int) -> Tuple[dict, bool]:
+        """Get the changes made after the ``since`` sequence number.
+
+        Args:
+            since: the sequence number of the last change known by the client
+
+        Returns:
+            the layers added and the tombstones of the layers removed since then,
+            oldest first, and whether the client must reset its state. On reset,
+            all the layers are returned and the client must drop the others. A
+            ``since`` ahead of the registry, known from before a restart of the
+            server, is a reset too.
+        """
+
+    @abstractmethod
+    def wait(self, since: int, timeout: Optional[float] = None) -> bool:
+        """Wait for a change after the ``since`` sequence number.
+
+        Args:
+            since: the sequence number of the last change known by the caller
+            timeout: maximum time to wait in seconds
+
+        Returns:
+            True if there was a change, False on timeout
+        """
+
+    @abstractmethod
+    def viewport(self) -> Optional[dict]:
+        """Get the ``bbox`` and ``zoom`` of the map last shown in a browser, if any."""
+
+    @abstractmethod
+    def set_viewport(self, viewport: dict):
+        """Store the ``bbox`` and ``zoom`` of the map shown in a browser."""
+
+
+class LayerRegistry(BaseRegistry):
+    """In-memory layer store, only shared by the threads of a single process.
+
+    Args:
+        max_size: maximum number of layers kept in the registry
+    """
+
+    def __init__(self, max_size: int = MAX_LAYERS):
+        """Initialize an empty registry."""
+        self.max_size = max_size
+        self._layers: OrderedDict = OrderedDict()
+        self._removed: OrderedDict = OrderedDict()
+        self._horizon = 0
+        self._seq = 0
+        self._viewport: Optional[dict] = None
+        self._changed = threading.Condition()
+
+    @property
+    def seq(self) -> int:
+        """Sequence number of the last change."""
+        return self._seq
+
+    def __len__(self) -> int:
+        """Number of layers in the registry."""
+        return len(self._layers)
+
+    def __contains__(self, layer_id: str) -> bool:
+        """Check if a layer is in the registry."""
+        return layer_id in self._layers
+
+    def __getitem__(self, layer_id: str) -> dict:
+        """Get a layer from the registry."""
+        return self._layers[layer_id]
+
+    def get(self, layer_id: str, default=None) -> Optional[dict]:
+        """Get a layer from the registry or ``default`` if it's not there."""
+        return self._layers.get(layer_id, default)
+
+    def layers(self) -> dict:
+        """Get a copy of all the layers, oldest first."""
+        with self._changed:
+            return dict(self._layers)
+
+    def add(self, layer: dict, layer_id: Optional[str] = None) -> str:
+        """Add a layer, evicting the oldest ones if the registry is full."""
+        layer_id = layer_id or uuid.uuid4().hex
+        with self._changed:
+            self._seq += 1
+            layer["seq"] = self._seq
+            self._layers[layer_id] = layer
+            while len(self._layers) > self.max_size:
+                self._remove(next(iter(self._layers)))
+            self._changed.notify_all()
+        return layer_id
+
+    def remove(self, layer_id: str) -> bool:
+        """Remove a layer, return True if it was in the registry."""
+        with self._changed:
+            if layer_id not in self._layers:
+                return False
+            self._remove(layer_id)
+            self._changed.notify_all()
+        return True
+
+    def clear(self) -> int:
+        """Remove all the layers and return how many were removed."""
+        with self._changed:
+            removed = list(self._layers)
+            for layer_id in removed:
+                self._remove(layer_id)
+            self._changed.notify_all()
+        return len(removed)
+
+    def _remove(self, layer_id: str):
+        """Replace a layer by a tombstone, must hold the lock."""
+        del self._layers[layer_id]
+        self._seq += 1
+        self._removed[layer_id] = self._seq
+        while len(self._removed) > self.max_size:
+            _, self._horizon = self._removed.popitem(last=False)
+
+    def changes(self, since: int) -> Tuple[dict, bool]:
+        """Get the changes made after the ``since`` sequence number."""
+        with self._changed:
+            if since < self._horizon or since > self._seq:
+                return dict(self._layers), True
+            changes = []
+            for layer_id, layer in reversed(self._layers.items()):
+                if layer["seq"] <= since:
+                    break
+                changes.append((layer["seq"], layer_id, layer))
+            for layer_id, seq in reversed(self._removed.items()):
+                if seq <= since:
+                    break
+                changes.append((seq, layer_id, {"seq": seq, "removed": True}))
+        changes.sort(key=lambda change: change[0])
+        return {layer_id: layer for _, layer_id, layer in changes}, False
+
+    def wait(self, since: int, timeout: Optional[float] = None) -> bool:
+        """Wait for a change after the ``since`` sequence number."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._seq > since, timeout)
+
+    def viewport(self) -> Optional[dict]:
+        """Get the ``bbox`` and ``zoom`` of the map last shown in a browser, if any."""
+        return self._viewport
+
+    def set_viewport(self, viewport: dict):
+        """Store the ``bbox`` and ``zoom`` of the map shown in a browser."""
+        self._viewport = dict(viewport)
+
+
+class SQLiteRegistry(BaseRegistry):
+    """Layer store kept in a SQLite database in WAL mode.
+
+    The database can be shared by several processes, e.g. the workers of a WSGI
+    server. Sequence numbers are allocated in write transactions so they stay
+    atomic across processes, and changes made by other processes are detected
+    by polling the last sequence number every ``poll_interval`` seconds.
+
+    Args:
+        path: the path of the database file
+        max_size: maximum number of layers kept in the registry
+        poll_interval: seconds between two checks for changes made elsewhere
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS layers (
+            layer_id TEXT PRIMARY KEY, seq INTEGER NOT NULL, layer TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS layers_seq ON layers (seq);
+        CREATE TABLE IF NOT EXISTS removed (
+            layer_id TEXT PRIMARY KEY, seq INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS removed_seq ON removed (seq);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS viewport (
+            id INTEGER PRIMARY KEY CHECK (id = 0), viewport TEXT NOT NULL
+        );
+        INSERT OR IGNORE INTO meta VALUES ('seq', 0), ('horizon', 0);
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path] = DEFAULT_SQLITE_PATH,
+        max_size: int = MAX_LAYERS,
+        poll_interval: float = 0.2,
+    ):
+        """Open the database and create its tables if needed."""
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._changed = threading.Condition()
+        self._db.executescript(self._SCHEMA)
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """Connection of the current thread, opened on first use."""
+        db = getattr(self._local, "db", None)
+        # a connection must not be used by a forked process
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Run the block in a write transaction and notify the waiting threads."""
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        with self._changed:
+            self._changed.notify_all()
+
+    def _meta(self, db: sqlite3.Connection, key: str) -> int:
+        """Read a value of the meta table."""
+        return db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+    def _next_seq(self, db: sqlite3.Connection) -> int:
+        """Allocate the next sequence number, must be in a write transaction."""
+        db.execute("UPDATE meta SET value = value + 1 WHERE key = 'seq'")
+        return self._meta(db, "seq")
+
+    @property
+    def seq(self) -> int:
+        """Sequence number of the last change."""
+        return self._meta(self._db, "seq")
+
+    def __len__(self) -> int:
+        """Number of layers in the registry."""
+        return self._db.execute("SELECT COUNT(*) FROM layers").fetchone()[0]
+
+    def get(self, layer_id: str, default=None) -> Optional[dict]:
+        """Get a layer from the registry or ``default`` if it's not there."""
+        query = "SELECT layer FROM layers WHERE layer_id = ?"
+        row = self._db.execute(query, (layer_id,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def layers(self) -> dict:
+        """Get a copy of all the layers, oldest first."""
+        rows = self._db.execute("SELECT layer_id, layer FROM layers ORDER BY seq")
+        return {layer_id: json.loads(layer) for layer_id, layer in rows}
+
+    def add(self, layer: dict, layer_id: Optional[str] = None) -> str:
+        """Add a layer, evicting the oldest ones if the registry is full."""
+        layer_id = layer_id or uuid.uuid4().hex
+        with self._transaction() as db:
+            layer["seq"] = self._next_seq(db)
+            query = "INSERT INTO layers VALUES (?, ?, ?)"
+            db.execute(query, (layer_id, layer["seq"], json.dumps(layer)))
+            extra = len(self) - self.max_size
+            if extra > 0:
+                query = "SELECT layer_id FROM layers ORDER BY seq LIMIT ?"
+                for (old_id,) in db.execute(query, (extra,)).fetchall():
+                    self._remove(db, old_id)
+        return layer_id
+
+    def remove(self, layer_id: str) -> bool:
+        """Remove a layer, return True if it was in the registry."""
+        with self._transaction() as db:
+            if layer_id not in self:
+                return False
+            self._remove(db, layer_id)
+        return True
+
+    def clear(self) -> int:
+        """Remove all the layers and return how many were removed."""
+        with self._transaction() as db:
+            rows = db.execute("SELECT layer_id FROM layers ORDER BY seq").fetchall()
+            for (layer_id,) in rows:
+                self._remove(db, layer_id)
+        return len(rows)
+
+    def _remove(self, db: sqlite3.Connection, layer_id: str):
+        """Replace a layer by a tombstone, must be in a write transaction."""
+        db.execute("DELETE FROM layers WHERE layer_id = ?", (layer_id,))
+        query = "INSERT OR REPLACE INTO removed VALUES (?, ?)"
+        db.execute(query, (layer_id, self._next_seq(db)))
+        extra = db.execute("SELECT COUNT(*) FROM removed").fetchone()[0]
+        extra -= self.max_size
+        if extra > 0:
+            query = (
+                "SELECT MAX(seq) FROM (SELECT seq FROM removed ORDER BY seq LIMIT ?)"
+            )
+            horizon = db.execute(query, (extra,)).fetchone()[0]
+            db.execute("DELETE FROM removed WHERE seq <= ?", (horizon,))
+            db.execute("UPDATE meta SET value = ? WHERE key = 'horizon'", (horizon,))
+
+    def changes(self, since: int) -> Tuple[dict, bool]:
+        """Get the changes made after the ``since`` sequence number."""
+        db = self._db
+        # a read transaction gives a consistent snapshot of the tables
+        db.execute("BEGIN")
+        try:
+            if not self._meta(db, "horizon") <= since <= self._meta(db, "seq"):
+                return self.layers(), True
+            query = """
+                SELECT seq, layer_id, layer FROM layers WHERE seq > :since
+                UNION ALL
+                SELECT seq, layer_id, NULL FROM removed WHERE seq > :since
+                ORDER BY seq
+            """
+            rows = db.execute(query, {"since": since}).fetchall()
+        finally:
+            db.execute("COMMIT")
+        changes = {}
+        for seq, layer_id, layer in rows:
+            if layer is None:
+                changes[layer_id] = {"seq": seq, "removed": True}
+            else:
+                changes[layer_id] = json.loads(layer)
+        return changes, False
+
+    def wait(self, since: int, timeout: Optional[float] = None) -> bool:
+        """Wait for a change after the ``since`` sequence number."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while self.seq <= since:
+            remaining = self.poll_interval
+            if end is not None:
+                remaining = min(remaining, end - time.monotonic())
+                if remaining <= 0:
+                    return False
+            # woken up right away by the changes made in this process
+            with self._changed:
+                self._changed.wait(remaining)
+        return True
+
+    def viewport(self) -> Optional[dict]:
+        """Get the ``bbox`` and ``zoom`` of the map last shown in a browser, if any."""
+        row = self._db.execute("SELECT viewport FROM viewport").fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_viewport(self, viewport: dict):
+        """Store the ``bbox`` and ``zoom`` of the map shown in a browser."""
+        query = "INSERT OR REPLACE INTO viewport VALUES (0, ?)"
+        self._db.execute(query, (json.dumps(viewport),))
+
+
+def open_registry(
+    store: str = "memory",
+    path: Union[str, Path] = DEFAULT_SQLITE_PATH,
+    max_size: int = MAX_LAYERS,
+) -> BaseRegistry:
+    """Open a layer store.
+
+    Args:
+        store: ``memory`` for a single process server or ``sqlite`` to share the
+            layers between several processes
+        path: the path of the database file of the ``sqlite`` store
+        max_size: maximum number of layers kept in the registry
+
+    Returns:
+        the layer store
+    """
+    if store == "memory":
+        return LayerRegistry(max_size)
+    if store == "sqlite":
+        return SQLiteRegistry(path, max_size)
+    raise ValueError(f"Unknown layer store {store}, use 'memory' or 'sqlite'")
+
+
+class Sessions:
+    """Layer stores of the named sessions, opened on first write.
+
+    Each session has its own store, so a client only gets the layers of its
+    session and the cost of a request depends on the size of the session only.
+    The ``sqlite`` store of a session is a database next to ``path``.
+
+    Reading an unknown session doesn't open it. When ``max_sessions`` are open,
+    the least recently used one is closed to open a new one. A ``memory`` store
+    is only closed when it has no layers, as they would be lost, so a new session
+    is refused when all the others have layers.
+
+    Args:
+        store: ``memory`` or ``sqlite``, see :func:`open_registry`
+        path: the path of the database file of the default session
+        max_size: maximum number of layers kept in each session
+        max_sessions: number of sessions kept open
+        poll_interval: seconds between two checks for a session opened by another
+            process, with the ``sqlite`` store
+    """
+
+    def __init__(
+        self,
+        store: str = "memory",
+        path: Union[str, Path] = DEFAULT_SQLITE_PATH,
+        max_size: int = MAX_LAYERS,
+        max_sessions: int = MAX_SESSIONS,
+        poll_interval: float = 0.2,
+    ):
+        """Initialize the sessions without opening any."""
+        self.store = store
+        self.path = Path(path)
+        self.max_size = max_size
+        self.max_sessions = max_sessions
+        self.poll_interval = poll_interval
+        self._sessions: OrderedDict = OrderedDict()
+        self._opened = threading.Condition()
+
+    def __len__(self) -> int:
+        """Number of sessions open."""
+        return len(self._sessions)
+
+    def _path(self, name: str) -> Path:
+        """Path of the database of a session."""
+        return self.path.with_name(f"{self.path.stem}-{name}{self.path.suffix}")
+
+    def get(self, name: str, create: bool = False) -> Optional[BaseRegistry]:
+        """Get the store of a session, opening it if needed.
+
+        Args:
+            name: the name of the session
+            create: create the store of a session that doesn't exist yet,
+                otherwise None is returned for it
+
+        Raises:
+            ValueError: if the name is not made of 1 to 64 letters, digits, ``-``
+                or ``_``
+            TooManySessions: when a ``memory`` session can't be created because
+                all the open ones have layers
+        """
+        with self._opened:
+            registry = self._sessions.get(name)
+            if registry is not None:
+                self._sessions.move_to_end(name)
+                return registry
+            if not SESSION_NAME.fullmatch(name):
+                raise ValueError(f"Invalid session name {name!r}")
+            # a sqlite session exists once its database was created by any process
+            exists = self.store == "sqlite" and self._path(name).exists()
+            if not (create or exists):
+                return None
+            while len(self._sessions) >= self.max_sessions:
+                self._close_one()
+            registry = open_registry(self.store, self._path(name), self.max_size)
+            self._sessions[name] = registry
+            self._opened.notify_all()
+            return registry
+
+    def _close_one(self):
+        """Close the least recently used session that can be, must hold the lock."""
+        for name, registry in self._sessions.items():
+            if self.store == "sqlite" or len(registry) == 0:
+                del self._sessions[name]
+                return
+        raise TooManySessions(self.max_sessions)
+
+    def wait(
+        self, name: str, timeout: Optional[float] = None
+    ) -> Optional[BaseRegistry]:
+        """Wait for a session to be opened.
+
+        Args:
+            name: the name of the session
+            timeout: maximum time to wait in seconds
+
+        Returns:
+            the store of the session, None on timeout
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            registry = self.get(name)
+            if registry is not None:
+                return registry
+            remaining = self.poll_interval
+            if end is not None:
+                remaining = min(remaining, end - time.monotonic())
+                if remaining <= 0:
+                    return None
+            # woken up right away by the sessions opened in this process
+            with self._opened:
+                if name not in self._sessions:
+                    self._opened.wait(remaining)
@@ -0,0 +1,128 @@
+"""Production server running the app with bounded concurrency in several processes."""
+
+import os
+import signal
+import socket
+import socketserver
+import threading
+from contextlib import suppress
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+THREADS = 32
+WORKERS = 1
+IDLE_TIMEOUT = 30  # seconds before an idle keep-alive connection is closed
+STREAMS = ("/events",)  # paths of the responses streamed as long as a page is open
+
+
+class RequestHandler(WSGIRequestHandler):
+    """Request handler closing the keep-alive connections left idle.
+
+    The requests wait for one of the ``threads`` slots of the server, except the
+    streams which would hold it as long as their page is open.
+    """
+
+    timeout = IDLE_TIMEOUT
+
+    def run_wsgi(self):
+        """Run the app once a slot is free, right away for a stream."""
+        if self.path.split("?")[0].endswith(self.server.streams):
+            return super().run_wsgi()
+        with self.server.slots:
+            return super().run_wsgi()
+
+
+class PooledWSGIServer(socketserver.ThreadingMixIn, BaseWSGIServer):
+    """WSGI server running at most ``threads`` requests at the same time.
+
+    Each connection has its own thread, but only ``threads`` of them run the
+    app at once, the others wait for a slot. The streams, e.g. a browser
+    listening to ``/events``, don't take a slot so the open pages don't
+    block the other requests.
+
+    Args:
+        host: the address to bind
+        port: the port to bind
+        app: the WSGI application
+        threads: number of requests running the app at the same time
+        fd: file descriptor of a socket already bound, shared by the workers
+        streams: ends of the paths of the streamed responses
+    """
+
+    multithread = True
+    daemon_threads = False
+    block_on_close = True  # server_close waits for the connections
+
+    def __init__(self, host, port, app, threads=THREADS, fd=None, streams=STREAMS):
+        """Create the server and its slots."""
+        self.slots = threading.BoundedSemaphore(threads)
+        self.streams = tuple(streams)
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+
+    def drain(self):
+        """Wait for the requests in flight once the server stopped accepting new ones."""
+        self.server_close()
+
+
+def serve(app, host, port, workers=WORKERS, threads=THREADS, on_shutdown=None):
+    """Serve ``app`` until SIGINT or SIGTERM, then drain the requests in flight.
+
+    With more than one worker, the listening socket is opened once and shared by
+    ``workers`` forked processes, each one running its own pool of threads.
+
+    Args:
+        app: the WSGI application
+        host: the address to bind
+        port: the port to bind
+        workers: number of processes, only 1 is supported where fork is not
+        threads: number of threads of each process
+        on_shutdown: called when a process starts shutting down
+    """
+    if workers > 1 and not hasattr(os, "fork"):
+        print("Multiple workers need os.fork, running a single process instead")
+        workers = 1
+    print(
+        f"Serving on http://{host}:{port} with {workers} worker(s) of {threads} threads"
+    )
+    if workers == 1:
+        _serve_worker(app, host, port, threads, None, on_shutdown)
+        return
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family, backlog=128)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve_worker(app, host, port, threads, sock.fileno(), on_shutdown)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            with suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+    sock.close()
+
+
+def _serve_worker(app, host, port, threads, fd, on_shutdown):
+    """Run a server in the current process until it receives SIGINT or SIGTERM."""
+    server = PooledWSGIServer(host, port, app, threads=threads, fd=fd)
+
+    def stop(signum, frame):
+        if on_shutdown is not None:
+            on_shutdown()
+        # shutdown waits for serve_forever to return so it can't run in its thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+    server.drain()
@@ -0,0 +1,82 @@
+"""Opt-in timing of the stages of a call, reported in ``Server-Timing`` headers.
+
+A trace is attached to the current thread by ``start``, the ``span`` blocks
+executed until ``stop`` record their duration in it. Without a trace, a span
+only costs a thread-local lookup.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+HEADER = "X-Geeservermap-Trace"  # asks the server for a Server-Timing header
+
+_local = threading.local()
+
+
+class Trace:
+    """Durations of the stages of a call, in seconds."""
+
+    def __init__(self):
+        """Initialize a trace without spans."""
+        self.spans: List[Tuple[str, float]] = []
+
+    def add(self, name: str, duration: float):
+        """Record a stage of ``duration`` seconds."""
+        self.spans.append((name, duration))
+
+    def report(self) -> Dict[str, float]:
+        """Get the duration in ms of each stage, summing the repeated ones."""
+        stages: Dict[str, float] = {}
+        for name, duration in self.spans:
+            stages[name] = stages.get(name, 0) + duration * 1000
+        return stages
+
+    def header(self) -> str:
+        """Format the stages as the value of a ``Server-Timing`` header."""
+        return ", ".join(f"{n};dur={d:.3f}" for n, d in self.report().items())
+
+
+def start() -> Trace:
+    """Attach a new trace to the current thread and return it."""
+    _local.trace = Trace()
+    return _local.trace
+
+
+def current() -> Optional[Trace]:
+    """Get the trace of the current thread, None if it isn't traced."""
+    return getattr(_local, "trace", None)
+
+
+def stop() -> Optional[Trace]:
+    """Detach the trace of the current thread and return it."""
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    return trace
+
+
+@contextmanager
+def span(name: str):
+    """Record the duration of the ``with`` block in the trace of the thread, if any."""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - begin)
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """Get the duration in ms of each metric of a ``Server-Timing`` header."""
+    timings: Dict[str, float] = {}
+    for metric in (header or "").split(","):
+        name, *params = (p.strip() for p in metric.split(";"))
+        if not name:
+            continue
+        durations = [p[4:] for p in params if p.startswith("dur=")]
+        timings[name] = float(durations[0]) if durations else 0.0
+    return timings
@@ -0,0 +1,124 @@
+"""HTTP transport between the Map client and the server."""
+
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import tracing
+from .exceptions import ServerNotRunning
+
+HOST = "localhost"
+PORT = 8018
+CONNECT_TIMEOUT = 2  # seconds, the server is expected to run on the same network
+READ_TIMEOUT = 30
+RETRIES = 2
+BACKOFF = 0.1  # seconds, doubled after each retry
+
+
+class SafeRetry(Retry):
+    """Retry policy retrying the requests that aren't idempotent only on 503.
+
+    The server answers 503 before doing anything when it runs too many jobs,
+    while a proxy may answer 502 or 504 after a POST registered its layer,
+    which would then be registered twice.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        """Whether a request answered with ``status_code`` can be sent again."""
+        if not self._is_method_retryable(method):
+            return status_code == 503 and status_code in self.status_forcelist
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class Transport:
+    """Pooled keep-alive HTTP client sending JSON requests to the server.
+
+    The connections are kept open between the calls so only the first request
+    pays for the connection setup. Requests answered with a transient error
+    are retried a bounded number of times with an exponential backoff, while a
+    refused connection fails over to :class:`ServerNotRunning` right away.
+
+    Args:
+        port: the port of the server
+        host: the host of the server
+        session: the name of the session the requests are sent to, None for the
+            default session
+        timeout: connect and read timeouts in seconds
+        retries: maximum number of retries of a request
+        backoff: base of the exponential backoff between retries in seconds
+    """
+
+    def __init__(
+        self,
+        port: int,
+        host: str = HOST,
+        session: Optional[str] = None,
+        timeout: tuple = (CONNECT_TIMEOUT, READ_TIMEOUT),
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+    ):
+        """Create the session and mount the pooled adapter."""
+        self.port = port
+        self.prefix = "" if session is None else f"/s/{session}"
+        self.url = f"http://{host}:{port}{self.prefix}"
+        self.timeout = timeout
+        retry = SafeRetry(
+            total=retries,
+            connect=0,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            # the last response is returned so raise_for_status raises its error
+            raise_on_status=False,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(max_retries=retry))
+
+    def request(self, method: str, path: str, **kwargs) -> dict:
+        """Send a request to the server and decode its JSON response.
+
+        When the thread is traced, the server is asked for the timing of its
+        stages, which are added to the trace with a ``server.`` prefix.
+
+        Args:
+            method: the HTTP method
+            path: the path of the endpoint, starting with a slash
+            kwargs: other arguments passed to ``requests.Session.request``
+
+        Returns:
+            the decoded JSON response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        trace = tracing.current()
+        if trace is not None:
+            kwargs.setdefault("headers", {})[tracing.HEADER] = "1"
+        try:
+            with tracing.span("http"):
+                response = self.session.request(method, self.url + path, **kwargs)
+        except requests.exceptions.ConnectionError:
+            raise ServerNotRunning(self.port)
+        if trace is not None:
+            timings = tracing.parse_server_timing(response.headers.get("Server-Timing"))
+            for name, duration in timings.items():
+                trace.add(f"server.{name}", duration / 1000)
+        response.raise_for_status()
+        return response.json()
+
+    def get(self, path: str, params: Optional[dict] = None) -> dict:
+        """Send a GET request to the server."""
+        return self.request("GET", path, params=params)
+
+    def post(self, path: str, data=None) -> dict:
+        """Send ``data`` as the JSON body of a POST request to the server."""
+        return self.request("POST", path, json=data)
+
+    def delete(self, path: str) -> dict:
+        """Send a DELETE request to the server."""
+        return self.request("DELETE", path)
+
+    def close(self):
+        """Close the pooled connections."""
+        self.session.close()
@@ -0,0 +1,177 @@
+"""HTTP client of the upstream tile servers, shared by all the server threads.
+
+Concurrent fetches of the same URL share a single request, so the tabs looking
+at the same area cost one request per tile. The requests sent to each host
+are limited in number and in rate, and those answered with 429 or 5xx are
+retried after a jittered exponential backoff.
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import tracing
+
+CONCURRENCY = 16  # requests in flight to each host
+RATE = 0.0  # requests per second to each host, 0 for no limit
+BURST = 32  # requests sent at once when the rate limit allows it
+RETRIES = 3
+BACKOFF = 0.5  # seconds, the maximum delay doubles after each retry
+MAX_BACKOFF = 10
+TIMEOUT = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Rate limit refilled with ``rate`` tokens per second, up to ``burst`` tokens.
+
+    Args:
+        rate: tokens added per second, 0 for no limit
+        burst: maximum number of tokens
+    """
+
+    def __init__(self, rate: float, burst: int):
+        """Initialize a full bucket."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if the bucket is empty."""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _retry_after(response) -> Optional[float]:
+    """Get the delay in seconds asked by a ``Retry-After`` header, if any."""
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class Upstream:
+    """Pooled keep-alive client coalescing, limiting and retrying tile fetches.
+
+    Args:
+        concurrency: maximum number of requests in flight to each host
+        rate: maximum number of requests per second to each host, 0 for no limit
+        burst: number of requests sent at once before the rate limit applies
+        retries: maximum number of retries of a request answered with 429 or 5xx
+        backoff: maximum delay before the first retry in seconds
+        timeout: connect and read timeout in seconds
+    """
+
+    def __init__(
+        self,
+        concurrency: int = CONCURRENCY,
+        rate: float = RATE,
+        burst: int = BURST,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+        timeout: float = TIMEOUT,
+    ):
+        """Create the session and mount the pooled adapters."""
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.stats = {"requests": 0, "coalesced": 0, "retries": 0}
+        self._hosts: Dict[str, Tuple[threading.BoundedSemaphore, TokenBucket]] = {}
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _limits(self, url: str) -> Tuple[threading.BoundedSemaphore, TokenBucket]:
+        """Get the concurrency and the rate limits of the host of ``url``."""
+        host = urlsplit(url).netloc
+        with self._lock:
+            limits = self._hosts.get(host)
+            if limits is None:
+                semaphore = threading.BoundedSemaphore(self.concurrency)
+                limits = (semaphore, TokenBucket(self.rate, self.burst))
+                self._hosts[host] = limits
+        return limits
+
+    def get(self, url: str) -> Tuple[int, Optional[bytes]]:
+        """Fetch ``url``, sharing the request with the concurrent fetches of it.
+
+        Args:
+            url: the URL of the tile
+
+        Returns:
+            the status code and the content, None unless the status code is 200.
+            The status code is 502 if the host couldn't be reached.
+        """
+        with self._lock:
+            inflight = self._inflight.get(url)
+            if inflight is None:
+                future: Future = Future()
+                self._inflight[url] = future
+            else:
+                self.stats["coalesced"] += 1
+        if inflight is not None:
+            with tracing.span("coalesced"):
+                return inflight.result()
+        try:
+            result = self._fetch(url)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._inflight[url]
+        return result
+
+    def _fetch(self, url: str) -> Tuple[int, Optional[bytes]]:
+        """Send the request within the limits of its host, retrying if needed."""
+        semaphore, bucket = self._limits(url)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            with self._lock:
+                self.stats["requests"] += 1
+            try:
+                with semaphore:
+                    response = self.session.get(url, timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                return 502, None
+            status = response.status_code
+            if status == 200:
+                return status, response.content
+            if status not in RETRY_STATUSES or attempt == self.retries:
+                return status, None
+            # full jitter, so the clients throttled together don't retry together
+            delay = random.uniform(0, min(MAX_BACKOFF, self.backoff * 2**attempt))
+            delay = max(delay, min(MAX_BACKOFF, _retry_after(response) or 0))
+            with self._lock:
+                self.stats["retries"] += 1
+            with tracing.span("backoff"):
+                time.sleep(delay)
+            attempt += 1
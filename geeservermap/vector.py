@@ -0,0 +1,456 @@
+"""Vector layers served in tiles simplified for the zoom level."""
+
+import json
+import math
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+from .cache import MemoryCache
+
+DEFAULT_VECTOR_DIR = Path(tempfile.gettempdir()) / "geeservermap" / "vectors"
+INDEX_ZOOM = 8  # zoom of the grid indexing the features
+TILE_SIZE = 256
+BUFFER = 8  # pixels kept around a tile so the edges made by clipping aren't drawn
+Bounds = Tuple[float, float, float, float]
+
+
+def tile_bounds(z: int, x: int, y: int) -> Bounds:
+    """Get the ``(west, south, east, north)`` bounds of a web mercator tile."""
+    n = 2**z
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+
+def tile_range(bounds, z: int) -> Tuple[int, int, int, int]:
+    """Get the ``(xmin, ymin, xmax, ymax)`` tiles covering ``bounds`` at zoom ``z``."""
+    n = 2**z
+    west, south, east, north = bounds
+
+    def x(lon):
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+
+    def y(lat):
+        lat = math.radians(max(-85.0511, min(85.0511, lat)))
+        merc = math.log(math.tan(lat) + 1 / math.cos(lat))
+        return min(n - 1, max(0, int((1 - merc / math.pi) / 2 * n)))
+
+    return x(west), y(north), x(east), y(south)
+
+
+def simplify(points: List, tolerance: float) -> List:
+    """Simplify a line with the Douglas-Peucker algorithm.
+
+    Args:
+        points: the ``[lon, lat]`` coordinates of the line
+        tolerance: maximum distance between the line and its simplification
+
+    Returns:
+        the coordinates that are kept
+    """
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first][:2], points[last][:2]
+        dx, dy = x2 - x1, y2 - y1
+        norm = math.hypot(dx, dy)
+        farthest, distance = None, tolerance
+        for i in range(first + 1, last):
+            px, py = points[i][:2]
+            if norm:
+                d = abs(dy * px - dx * py + x2 * y1 - y2 * x1) / norm
+            else:
+                d = math.hypot(px - x1, py - y1)
+            if d > distance:
+                farthest, distance = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def simplify_geometry(geometry: dict, tolerance: float) -> Optional[dict]:
+    """Simplify a GeoJSON geometry, dropping the parts smaller than ``tolerance``.
+
+    Args:
+        geometry: the GeoJSON geometry
+        tolerance: the simplification tolerance in degrees
+
+    Returns:
+        the simplified geometry or None if nothing is left of it
+    """
+    digits = max(0, math.ceil(-math.log10(tolerance))) + 1
+
+    def line(coords, closed):
+        coords = [
+            [round(c, digits) for c in p[:2]] for p in simplify(coords, tolerance)
+        ]
+        return coords if len(coords) >= (4 if closed else 2) else None
+
+    def polygon(rings):
+        rings = [line(ring, True) for ring in rings]
+        return [r for r in rings if r] if rings and rings[0] else None
+
+    kind, coords = geometry["type"], geometry.get("coordinates") or []
+    simplified: Optional[list]
+    if kind == "Point":
+        simplified = [round(c, digits) for c in coords[:2]]
+    elif kind == "MultiPoint":
+        simplified = [[round(c, digits) for c in p[:2]] for p in coords]
+    elif kind == "LineString":
+        simplified = line(coords, False)
+    elif kind == "MultiLineString":
+        simplified = [s for s in (line(c, False) for c in coords) if s] or None
+    elif kind == "Polygon":
+        simplified = polygon(coords)
+    elif kind == "MultiPolygon":
+        simplified = [s for s in (polygon(c) for c in coords) if s] or None
+    elif kind == "GeometryCollection":
+        parts = [simplify_geometry(g, tolerance) for g in geometry["geometries"]]
+        parts = [p for p in parts if p]
+        return {"type": kind, "geometries": parts} if parts else None
+    else:
+        return None
+    return {"type": kind, "coordinates": simplified} if simplified else None
+
+
+def _inside(point: List, bounds: Bounds) -> bool:
+    """Check if a point is in the ``(west, south, east, north)`` bounds."""
+    west, south, east, north = bounds
+    return west <= point[0] <= east and south <= point[1] <= north
+
+
+def _interpolate(a: List, b: List, t: float) -> List:
+    """Get the point at ``t`` along the segment from ``a`` to ``b``."""
+    if t <= 0:
+        return list(a[:2])
+    if t >= 1:
+        return list(b[:2])
+    return [a[0] + t * (b[0] - a[0]), a[1] + t * (b[1] - a[1])]
+
+
+def _clip_segment(a: List, b: List, bounds: Bounds) -> Optional[Tuple[float, float]]:
+    """Get the part of a segment in the bounds with the Liang-Barsky algorithm.
+
+    Returns:
+        the ``(start, end)`` of the part as fractions of the segment, or None if
+        the segment is out of the bounds
+    """
+    west, south, east, north = bounds
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    start, end = 0.0, 1.0
+    edges = (
+        (-dx, a[0] - west),
+        (dx, east - a[0]),
+        (-dy, a[1] - south),
+        (dy, north - a[1]),
+    )
+    for p, q in edges:
+        if p == 0:
+            if q < 0:
+                return None
+        elif p < 0:
+            start = max(start, q / p)
+        else:
+            end = min(end, q / p)
+    return (start, end) if start <= end else None
+
+
+def clip_line(line: List, bounds: Bounds) -> List[List]:
+    """Clip a line to the bounds, a line crossing them several times is split.
+
+    Args:
+        line: the ``[lon, lat]`` coordinates of the line
+        bounds: the ``(west, south, east, north)`` bounds
+
+    Returns:
+        the parts of the line in the bounds
+    """
+    parts: List[List] = []
+    part: List = []
+    for a, b in zip(line, line[1:]):
+        clipped = _clip_segment(a, b, bounds)
+        # the line left the bounds before this segment
+        if clipped is None or clipped[0] > 0:
+            if len(part) > 1:
+                parts.append(part)
+            part = []
+        if clipped is None:
+            continue
+        if not part:
+            part.append(_interpolate(a, b, clipped[0]))
+        part.append(_interpolate(a, b, clipped[1]))
+    if len(part) > 1:
+        parts.append(part)
+    return parts
+
+
+def clip_ring(ring: List, bounds: Bounds) -> Optional[List]:
+    """Clip a polygon ring to the bounds with the Sutherland-Hodgman algorithm.
+
+    The parts of the ring out of the bounds are replaced by the edges of the
+    bounds, which are kept out of sight by the buffer around the tiles.
+
+    Args:
+        ring: the ``[lon, lat]`` coordinates of the closed ring
+        bounds: the ``(west, south, east, north)`` bounds
+
+    Returns:
+        the closed clipped ring or None if nothing is left of it
+    """
+    points = [p[:2] for p in ring[:-1]]
+    west, south, east, north = bounds
+    for axis, limit, sign in (
+        (0, west, 1),
+        (0, east, -1),
+        (1, south, 1),
+        (1, north, -1),
+    ):
+        clipped = []
+        for previous, point in zip(points[-1:] + points[:-1], points):
+            inside = (point[axis] - limit) * sign >= 0
+            if inside != ((previous[axis] - limit) * sign >= 0):
+                t = (limit - previous[axis]) / (point[axis] - previous[axis])
+                clipped.append(_interpolate(previous, point, t))
+            if inside:
+                clipped.append(point)
+        points = clipped
+    return [*points, points[0]] if len(points) >= 3 else None
+
+
+def clip_geometry(geometry: dict, bounds: Bounds) -> Optional[dict]:
+    """Clip a GeoJSON geometry to the ``(west, south, east, north)`` bounds.
+
+    A LineString crossing the bounds several times becomes a MultiLineString.
+
+    Returns:
+        the clipped geometry or None if nothing is left of it
+    """
+
+    def polygon(rings):
+        rings = [clip_ring(ring, bounds) for ring in rings]
+        return [r for r in rings if r] if rings and rings[0] else None
+
+    kind, coords = geometry["type"], geometry.get("coordinates") or []
+    clipped: Optional[list]
+    if kind == "Point":
+        clipped = coords if _inside(coords, bounds) else None
+    elif kind == "MultiPoint":
+        clipped = [p for p in coords if _inside(p, bounds)]
+    elif kind == "LineString":
+        clipped = clip_line(coords, bounds)
+        if len(clipped) == 1:
+            clipped = clipped[0]
+        else:
+            kind = "MultiLineString"
+    elif kind == "MultiLineString":
+        clipped = [part for line in coords for part in clip_line(line, bounds)]
+    elif kind == "Polygon":
+        clipped = polygon(coords)
+    elif kind == "MultiPolygon":
+        clipped = [p for p in (polygon(c) for c in coords) if p]
+    elif kind == "GeometryCollection":
+        parts = [clip_geometry(g, bounds) for g in geometry["geometries"]]
+        parts = [p for p in parts if p]
+        return {"type": kind, "geometries": parts} if parts else None
+    else:
+        return None
+    return {"type": kind, "coordinates": clipped} if clipped else None
+
+
+def _bounds(geometry: Optional[dict]) -> Optional[Bounds]:
+    """Get the ``(west, south, east, north)`` bounds of a GeoJSON geometry."""
+    if geometry is None:
+        return None
+    parts: List[Bounds]
+    if geometry["type"] == "GeometryCollection":
+        bounds = (_bounds(g) for g in geometry["geometries"])
+        parts = [b for b in bounds if b is not None]
+    else:
+        points = []
+        stack = [geometry["coordinates"]]
+        while stack:
+            coords = stack.pop()
+            if coords and isinstance(coords[0], (int, float)):
+                points.append(coords)
+            else:
+                stack.extend(coords)
+        parts = [(p[0], p[1], p[0], p[1]) for p in points]
+    if not parts:
+        return None
+    return (
+        min(p[0] for p in parts),
+        min(p[1] for p in parts),
+        max(p[2] for p in parts),
+        max(p[3] for p in parts),
+    )
+
+
+class VectorIndex:
+    """Features of a vector layer indexed on a grid of tiles.
+
+    Args:
+        geojson: a GeoJSON FeatureCollection
+    """
+
+    def __init__(self, geojson: dict):
+        """Compute the bounds of the features and index them."""
+        self.features: List[dict] = []
+        self.bounds: List[Bounds] = []
+        self.grid: dict = {}
+        for feature in geojson.get("features", []):
+            bounds = _bounds(feature.get("geometry"))
+            if bounds is None:
+                continue
+            i = len(self.features)
+            self.features.append(feature)
+            self.bounds.append(bounds)
+            xmin, ymin, xmax, ymax = tile_range(bounds, INDEX_ZOOM)
+            for x in range(xmin, xmax + 1):
+                for y in range(ymin, ymax + 1):
+                    self.grid.setdefault((x, y), []).append(i)
+
+    def tile(self, z: int, x: int, y: int) -> dict:
+        """Get the features intersecting a tile, simplified for its zoom level.
+
+        The features are clipped to the tile and a buffer of ``BUFFER`` pixels
+        around it, so a large feature is sent in parts, and features smaller
+        than a pixel are dropped. Each feature gets its index as ``id``.
+
+        Returns:
+            a GeoJSON FeatureCollection
+        """
+        west, south, east, north = tile_bounds(z, x, y)
+        dx, dy = (east - west) * BUFFER / TILE_SIZE, (
+            north - south
+        ) * BUFFER / TILE_SIZE
+        west, south, east, north = west - dx, south - dy, east + dx, north + dy
+        if z >= INDEX_ZOOM:
+            shift = z - INDEX_ZOOM
+            candidates = self.grid.get((x >> shift, y >> shift), [])
+        else:
+            candidates = range(len(self.features))
+        tolerance = 360 / (TILE_SIZE * 2**z)
+        features: List[dict] = []
+        for i in candidates:
+            w, s, e, n = self.bounds[i]
+            if w > east or e < west or s > north or n < south:
+                continue
+            geometry = self.features[i]["geometry"]
+            if w < west or e > east or s < south or n > north:
+                geometry = clip_geometry(geometry, (west, south, east, north))
+                if geometry is None:
+                    continue
+            geometry = simplify_geometry(geometry, tolerance)
+            if geometry is None:
+                continue
+            properties = self.features[i].get("properties")
+            features.append(
+                {
+                    "type": "Feature",
+                    "id": i,
+                    "geometry": geometry,
+                    "properties": properties,
+                }
+            )
+        return {"type": "FeatureCollection", "features": features}
+
+
+class VectorStore:
+    """Vector layers saved on disk and served from a cache of simplified tiles.
+
+    The GeoJSON of each layer is saved in ``directory``, in a sub folder for the
+    layers of a named session, so every server process can load it, and its
+    index is kept in memory once loaded.
+
+    Args:
+        directory: the folder where the GeoJSON of the layers are saved
+        max_layers: number of layer indexes kept in memory
+        max_tiles: number of simplified tiles kept in memory
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path] = DEFAULT_VECTOR_DIR,
+        max_layers: int = 16,
+        max_tiles: int = 4096,
+    ):
+        """Initialize the store and its caches."""
+        self.directory = Path(directory)
+        self.indexes = MemoryCache(max_size=max_layers)
+        self.tiles = MemoryCache(max_size=max_tiles)
+        self._lock = threading.Lock()
+
+    def _folder(self, session: Optional[str] = None) -> Path:
+        """Folder of the GeoJSON of the layers of a session."""
+        if session is None:
+            return self.directory
+        return self.directory / "sessions" / session
+
+    def _path(self, layer_id: str, session: Optional[str] = None) -> Path:
+        """Path of the GeoJSON of a layer."""
+        return self._folder(session) / f"{layer_id}.geojson"
+
+    def add(self, layer_id: str, geojson: dict, session: Optional[str] = None):
+        """Save the GeoJSON FeatureCollection of a layer."""
+        self._folder(session).mkdir(parents=True, exist_ok=True)
+        self._path(layer_id, session).write_text(json.dumps(geojson))
+
+    def remove(self, layer_id: str, session: Optional[str] = None):
+        """Delete the GeoJSON of a layer."""
+        self._path(layer_id, session).unlink(missing_ok=True)
+
+    def prune(self, keep, grace: float = 60, session: Optional[str] = None):
+        """Delete the GeoJSON of the layers of a session that are not in ``keep``.
+
+        Args:
+            keep: the ids of the layers to keep, e.g. the layer registry
+            grace: age in seconds under which a file is kept anyway, as its
+                layer may be about to be registered by another process
+            session: the name of the session, None for the default one
+        """
+        now = time.time()
+        for path in self._folder(session).glob("*.geojson"):
+            if path.stem not in keep and now - path.stat().st_mtime > grace:
+                path.unlink(missing_ok=True)
+
+    def index(
+        self, layer_id: str, session: Optional[str] = None
+    ) -> Optional[VectorIndex]:
+        """Get the index of a layer, loading it from disk if needed."""
+        index = self.indexes.get(layer_id)
+        if index is None:
+            # a single thread builds the index, the others wait for it
+            with self._lock:
+                index = self.indexes.get(layer_id)
+                if index is None:
+                    path = self._path(layer_id, session)
+                    if not path.is_file():
+                        return None
+                    index = VectorIndex(json.loads(path.read_text()))
+                    self.indexes.set(layer_id, index)
+        return index
+
+    def tile(
+        self, layer_id: str, z: int, x: int, y: int, session: Optional[str] = None
+    ) -> Optional[bytes]:
+        """Get the simplified GeoJSON of a tile, encoded, or None if the layer is unknown."""
+        key = (layer_id, z, x, y)
+        data = self.tiles.get(key)
+        if data is None:
+            index = self.index(layer_id, session)
+            if index is None:
+                return None
+            data = json.dumps(index.tile(z, x, y), separators=(",", ":")).encode()
+            self.tiles.set(key, data)
+        return data
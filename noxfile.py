@@ -3,6 +3,8 @@
 The nox run are build in isolated environment that will be stored in .nox. to force the venv update, remove the .nox/xxx folder.
 """
 
+from pathlib import Path
+
 import nox
 
 nox.options.sessions = ["lint", "test", "docs", "mypy"]
@@ -23,6 +25,26 @@ def test(session):
     session.run("pytest", "--color=yes", "--cov", "--cov-report=xml", *test_files)
 
 
+@nox.session(reuse_venv=True)
+def bench(session):
+    """Run the benchmarks, save their results and compare them with the last saved ones."""
+    session.install(".[test]")
+    storage = "--benchmark-storage=benchmarks/results"
+    compare = (
+        ["--benchmark-compare"]
+        if list(Path("benchmarks/results").glob("*/*.json"))
+        else []
+    )
+    session.run(
+        "pytest",
+        "benchmarks",
+        storage,
+        "--benchmark-autosave",
+        *compare,
+        *session.posargs,
+    )
+
+
 @nox.session(reuse_venv=True, name="dead-fixtures")
 def dead_fixtures(session):
     """Check for dead fixtures within the tests."""
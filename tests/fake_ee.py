@@ -0,0 +1,161 @@
+"""Local stand-in of the Earth Engine API answering after a configurable latency."""
+
+import threading
+import time
+from types import SimpleNamespace
+
+
+class Computed:
+    """A computed object evaluated by ``getInfo``, each call is a round trip."""
+
+    def __init__(self, ee, value):
+        """Wrap the ``value`` the server would compute."""
+        self.ee = ee
+        self.value = value
+
+    def getInfo(self):
+        """Evaluate the object, and the objects it contains, in one round trip."""
+        self.ee.round_trip()
+        return self.ee.evaluate(self.value)
+
+
+class FakeImage:
+    """Stand-in of an ``ee.Image`` identified by its serialized expression."""
+
+    ee = None  # the FakeEE the image class is bound to
+
+    def __init__(self, expression="image"):
+        """Build an image out of a fake serialized expression."""
+        self.expression = expression
+
+    def serialize(self):
+        """Serialized expression of the image."""
+        return self.expression
+
+    def bandNames(self):
+        """Names of the bands of the image."""
+        return Computed(self.ee, list(self.ee.bands))
+
+    def bandTypes(self):
+        """Types of the bands of the image, all unsigned 16 bits integers."""
+        btype = {"type": "PixelType", "precision": "int", "min": 0, "max": 65535}
+        return Computed(self.ee, {band: dict(btype) for band in self.ee.bands})
+
+    def select(self, bands):
+        """Select bands, the fake images have the same bands whatever selected."""
+        return self
+
+    def reduceRegion(self, reducer, geometry=None, scale=None, **kwargs):
+        """Reduce the image, the ``p`` percentile of every band is ``10 * p``.
+
+        The first value of every band is the number of the band.
+        """
+        self.ee.reductions.append({"geometry": geometry, "scale": scale, **kwargs})
+        if reducer.percentiles is None:
+            return {band: i for i, band in enumerate(self.ee.bands, 1)}
+        stats = {
+            f"{band}_p{p}": 10 * p
+            for band in self.ee.bands
+            for p in reducer.percentiles
+        }
+        return Computed(self.ee, stats)
+
+    def getMapId(self, params):
+        """Mint a tile URL for the image and the visualization ``params``."""
+        self.ee.round_trip()
+        mapid = f"{abs(hash((self.expression, str(sorted(params.items()))))):x}"
+        url = f"https://ee.test/{mapid}/tiles/{{z}}/{{x}}/{{y}}"
+        return {"mapid": mapid, "tile_fetcher": SimpleNamespace(url_format=url)}
+
+
+class FakeGeometry:
+    """Stand-in of an ``ee.Geometry``."""
+
+    def __init__(self, coords=None):
+        """Build a geometry out of its coordinates."""
+        self.coords = coords
+
+    @classmethod
+    def Point(cls, coords, proj=None):
+        """Build a point out of its ``[lon, lat]`` coordinates."""
+        return cls(coords)
+
+    @classmethod
+    def Rectangle(cls, coords, proj=None, geodesic=True):
+        """Build a rectangle out of its ``[west, south, east, north]`` bounds."""
+        return cls(coords)
+
+    def serialize(self):
+        """Serialized expression of the geometry."""
+        return f"geometry-{self.coords}"
+
+
+class FakeEE:
+    """Stand-in of the ``ee`` module for the parts geeservermap uses.
+
+    Each evaluation (``getInfo`` and ``getMapId``) sleeps ``latency`` seconds
+    and is counted in ``round_trips``.
+
+    Args:
+        latency: seconds taken by a round trip to Earth Engine
+        bands: names of the bands of the images
+    """
+
+    def __init__(self, latency=0.0, bands=("B1", "B2", "B3")):
+        """Create the module and its classes bound to it."""
+        self.latency = latency
+        self.bands = list(bands)
+        self.round_trips = 0
+        self._lock = threading.Lock()
+        self.Image = type("Image", (FakeImage,), {"ee": self})
+        self.reductions = []
+        self.Geometry = FakeGeometry
+        self.Reducer = SimpleNamespace(
+            percentile=lambda percentiles: SimpleNamespace(percentiles=percentiles),
+            first=lambda: SimpleNamespace(percentiles=None),
+        )
+        self.EEException = type("EEException", (Exception,), {})
+        self.Feature = type("Feature", (), {})
+        self.FeatureCollection = type("FeatureCollection", (), {})
+        self.data = SimpleNamespace(is_initialized=lambda: True)
+        self.deserializer = SimpleNamespace(fromJSON=self.Image)
+
+    def Initialize(self, *args, **kwargs):
+        """Nothing to initialize."""
+
+    def Dictionary(self, content):
+        """Build a dictionary of computed objects evaluated at once."""
+        return Computed(self, content)
+
+    def round_trip(self):
+        """Count a round trip and wait for its latency."""
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def evaluate(self, value):
+        """Replace the computed objects contained in ``value`` by their value."""
+        if isinstance(value, Computed):
+            return self.evaluate(value.value)
+        if isinstance(value, dict):
+            return {k: self.evaluate(v) for k, v in value.items()}
+        return value
+
+    def install(self, monkeypatch):
+        """Use the fake in place of ``ee`` in all the geeservermap modules."""
+        from geeservermap import helpers, main, map
+        from geeservermap.elements import layers
+
+        for module in [helpers, main, map, layers]:
+            monkeypatch.setattr(module, "ee", self)
+        self.clear_caches()
+
+    @staticmethod
+    def clear_caches():
+        """Forget the band types and map ids cached by geeservermap."""
+        from geeservermap import helpers
+        from geeservermap.elements import layers
+
+        helpers.BANDS_CACHE.clear()
+        layers.MAPID_CACHE.clear()
@@ -0,0 +1,122 @@
+"""Test the tile archives served as layers."""
+
+import gzip
+import sqlite3
+
+import pytest
+
+from geeservermap import main
+from geeservermap.archive import HEADER, PMTiles, TileArchives, tile_id
+from geeservermap.cache import TileCache
+
+TILES = {(0, 0, 0): b"\x89PNG 0", (1, 0, 1): b"\x89PNG 1", (1, 1, 0): b"\x89PNG 2"}
+
+
+def _varints(*values):
+    """Encode unsigned LEB128 varints."""
+    data = bytearray()
+    for value in values:
+        while value >= 0x80:
+            data.append(value & 0x7F | 0x80)
+            value >>= 7
+        data.append(value)
+    return bytes(data)
+
+
+def _directory(entries):
+    """Serialize ``(tile_id, run_length, offset, length)`` entries."""
+    ids = [e[0] for e in entries]
+    deltas = [b - a for a, b in zip([0, *ids], ids)]
+    return gzip.compress(
+        _varints(len(entries), *deltas)
+        + _varints(*(e[1] for e in entries))
+        + _varints(*(e[3] for e in entries))
+        + _varints(*(e[2] + 1 for e in entries))
+    )
+
+
+def write_pmtiles(path, tiles, leaf=False):
+    """Write a PMTiles archive of PNG tiles, in a leaf directory if ``leaf``."""
+    data, entries = b"", []
+    for tid, content in sorted((tile_id(*k), v) for k, v in tiles.items()):
+        entries.append((tid, 1, len(data), len(content)))
+        data += content
+    leaves = b""
+    if leaf:
+        leaves = _directory(entries)
+        entries = [(entries[0][0], 0, 0, len(leaves))]
+    root = _directory(entries)
+    n = len(tiles)
+    offsets = [HEADER.size, len(root), 0, 0, HEADER.size + len(root), len(leaves)]
+    offsets += [HEADER.size + len(root) + len(leaves), len(data), n, n, n]
+    header = HEADER.pack(b"PMTiles", 3, *offsets, 1, 2, 1, 2, 0, 1, *[0] * 7)
+    path.write_bytes(header + root + leaves + data)
+    return path
+
+
+def write_mbtiles(path, tiles):
+    """Write an MBTiles archive of PNG tiles."""
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+    db.execute("CREATE TABLE tiles (zoom_level, tile_column, tile_row, tile_data)")
+    db.executemany(
+        "INSERT INTO metadata VALUES (?, ?)",
+        [("format", "png"), ("minzoom", "0"), ("maxzoom", "1")],
+    )
+    db.executemany(
+        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+        [(z, x, (1 << z) - 1 - y, v) for (z, x, y), v in tiles.items()],
+    )
+    db.commit()
+    db.close()
+    return path
+
+
+def test_tile_id():
+    """Tiles are numbered along a Hilbert curve, zoom after zoom."""
+    assert [tile_id(0, 0, 0), tile_id(1, 0, 0), tile_id(1, 0, 1)] == [0, 1, 2]
+    assert [tile_id(1, 1, 1), tile_id(1, 1, 0), tile_id(2, 0, 0)] == [3, 4, 5]
+
+
+@pytest.mark.parametrize("kind", ["mbtiles", "pmtiles", "pmtiles-leaf"])
+def test_archive(tmp_path, kind):
+    """The tiles of the archives are read back, the missing ones are None."""
+    path = tmp_path / f"tiles.{kind[:7]}"
+    if kind == "mbtiles":
+        write_mbtiles(path, TILES)
+    else:
+        write_pmtiles(path, TILES, leaf=kind.endswith("leaf"))
+    archive = TileArchives().get(path)
+    assert archive.mimetype == "image/png"
+    for (z, x, y), content in TILES.items():
+        assert archive.tile(z, x, y) == content
+    assert archive.tile(1, 1, 1) is None
+    assert archive.tile(5, 1, 1) is None
+
+
+def test_invalid_archive(tmp_path):
+    """Files that aren't archives of images are rejected."""
+    (tmp_path / "tiles.pmtiles").write_bytes(b"not an archive")
+    with pytest.raises(ValueError):
+        PMTiles(tmp_path / "tiles.pmtiles")
+    with pytest.raises(ValueError):
+        TileArchives().get(tmp_path / "tiles.zip")
+
+
+def test_archive_layer(tmp_path):
+    """Archive layers are served by the server without any upstream request."""
+    state = main.AppState(tile_cache=TileCache(tmp_path / "tiles"))
+    client = main.create_app(state=state).test_client()
+    path = write_pmtiles(tmp_path / "basemap.pmtiles", TILES)
+    response = client.post("/add_archive", json={"path": str(path), "name": "base"})
+    layer_id = response.json["job_id"]
+    layer = state.messages[layer_id]
+    assert layer["url"] == f"/archive/{layer_id}/{{z}}/{{x}}/{{y}}"
+    assert layer["maxzoom"] == 1
+
+    response = client.get(f"/archive/{layer_id}/1/0/1")
+    assert response.data == TILES[(1, 0, 1)]
+    assert response.mimetype == "image/png"
+    assert client.get(f"/archive/{layer_id}/1/1/1").status_code == 404
+    missing = {"path": str(tmp_path / "missing.pmtiles")}
+    assert client.post("/add_archive", json=missing).status_code == 400
@@ -0,0 +1,98 @@
+"""Test the job store of async_jobs."""
+
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from geeservermap.async_jobs import Async
+from geeservermap.exceptions import TooManyJobs
+
+
+@pytest.fixture
+def jobs():
+    """A job store that can only hold 2 jobs."""
+    store = Async(max_workers=1, max_jobs=2)
+    yield store
+    store._terminate()
+
+
+def test_expiry(jobs):
+    """Finished jobs are removed once expired, running ones are kept."""
+    running = jobs._create_job()
+    finished = jobs._create_job()
+    jobs._finish_job(finished, "done")
+    jobs._remove_expired(finished["finished"] + jobs._TIMEOUT - 1)
+    assert len(jobs) == 2
+    jobs._remove_expired(finished["finished"] + jobs._TIMEOUT)
+    assert jobs.get_job_result(finished["id"]) is None
+    assert jobs.get_job_result(running["id"])["state"] == "created"
+
+
+def test_max_jobs(jobs):
+    """A full store evicts its finished jobs and refuses new ones otherwise."""
+    finished = jobs._create_job()
+    jobs._finish_job(finished, "done")
+    jobs._create_job()
+    jobs._create_job()
+    assert jobs.get_job_result(finished["id"]) is None
+    with pytest.raises(TooManyJobs):
+        jobs._create_job()
+
+
+def test_unknown_job(jobs):
+    """Reading an unknown job doesn't crash."""
+    assert jobs.get_job_result("unknown") is None
+
+
+def test_cancel(jobs):
+    """A tracked job sees its cancellation and ends in the cancelled state."""
+    started = threading.Event()
+
+    def work(job):
+        started.set()
+        while not job["cancelled"]:
+            started.wait(0.01)
+        return "stopped"
+
+    job = jobs.submit(work, track=True)
+    started.wait(1)
+    assert jobs.cancel(job["id"])
+    jobs.join()
+    assert jobs.get_job_result(job["id"])["state"] == "cancelled"
+    assert not jobs.cancel(job["id"])
+
+
+def test_exit_with_queued_jobs():
+    """The interpreter exits without running the queued jobs to the end."""
+    script = (
+        "import time\n"
+        "from geeservermap.async_jobs import Async\n"
+        "jobs = Async(max_workers=1)\n"
+        "running = jobs.submit(lambda job: job['cancelled'] or time.sleep(2), track=True)\n"
+        "[jobs.submit(time.sleep, 2) for _ in range(3)]\n"
+        "time.sleep(0.1)\n"
+    )
+    start = time.monotonic()
+    subprocess.run([sys.executable, "-c", script], check=True, timeout=10)
+    assert time.monotonic() - start < 2
+
+
+def test_terminate(jobs):
+    """Terminating drops the queued jobs and cancels the running ones."""
+    started, release = threading.Event(), threading.Event()
+
+    def work(job):
+        started.set()
+        release.wait(1)
+        return job["cancelled"]
+
+    running = jobs.submit(work, track=True)
+    queued = jobs.submit(time.sleep, 2)
+    started.wait(1)
+    jobs._terminate()
+    assert jobs.get_job_result(queued["id"])["state"] == "cancelled"
+    assert running["cancelled"]
+    release.set()
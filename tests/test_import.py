@@ -0,0 +1,43 @@
+"""Guard the import time of the package against regressions."""
+
+import subprocess
+import sys
+
+IMPORT_BUDGET = 50000  # us, importing the package alone takes about 1 ms
+
+
+def _imports(statement):
+    """Run ``statement`` in a fresh interpreter and get the time of each import.
+
+    Returns:
+        the cumulative import time in us of each imported module
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = line.split("|")
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative)
+    return times
+
+
+def test_import_package():
+    """Importing the package imports neither Earth Engine nor the server."""
+    times = _imports("import geeservermap")
+    assert "ee" not in times
+    assert "flask" not in times
+    assert times["geeservermap"] < IMPORT_BUDGET
+
+
+def test_import_client():
+    """The Map client doesn't import the Flask server."""
+    times = _imports("from geeservermap import Map")
+    assert "geeservermap.transport" in times
+    assert "flask" not in times
+    assert "geeservermap.main" not in times
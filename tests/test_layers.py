@@ -0,0 +1,91 @@
+"""Test the layers elements."""
+
+from types import SimpleNamespace
+
+from geeservermap import helpers
+from geeservermap.elements import layers
+
+from .fake_ee import FakeEE
+
+
+class FakeImage:
+    """Minimal stand-in of an ee.Image counting the getMapId calls."""
+
+    def __init__(self, expression):
+        """Build an image out of a fake serialized expression."""
+        self.expression = expression
+        self.calls = 0
+
+    def serialize(self):
+        """Serialized expression of the image."""
+        return self.expression
+
+    def getMapId(self, params):
+        """Mint a new tile URL on every call."""
+        self.calls += 1
+        url = f"https://ee/{self.expression}/{self.calls}/{{z}}/{{x}}/{{y}}"
+        return {"tile_fetcher": SimpleNamespace(url_format=url)}
+
+
+def test_mapid_cache():
+    """Adding the same image with the same visParams only mints one map id."""
+    layers.MAPID_CACHE.clear()
+    vis = layers.VisParams(["B4"], 0, 3000)
+    image = FakeImage("cached")
+    urls = {layers.Image(image, vis).url for _ in range(3)}
+    assert len(urls) == 1
+    assert image.calls == 1
+
+    other = layers.VisParams(["B4"], 0, 1000)
+    assert layers.Image(image, other).url not in urls
+    assert layers.Image(image, vis, cache=False).url not in urls
+    assert image.calls == 3
+
+
+def test_bands_info_single_request(monkeypatch):
+    """Band names and types are fetched in one cached request."""
+    requests = []
+
+    class Dictionary:
+        """Fake ee.Dictionary recording the evaluated requests."""
+
+        def __init__(self, content):
+            self.content = content
+
+        def getInfo(self):
+            """Evaluate the request."""
+            requests.append(self.content)
+            types = {"B4": {"precision": "int", "min": 0, "max": 10000}}
+            return {"names": ["B4", "B8"], "types": types}
+
+    monkeypatch.setattr(layers.helpers, "ee", SimpleNamespace(Dictionary=Dictionary))
+    layers.helpers.BANDS_CACHE.clear()
+    image = FakeImage("bands")
+    image.bandNames = image.bandTypes = lambda: None
+
+    for _ in range(2):
+        vis = layers.VisParams.from_image(image)
+        assert vis.bands == ["B4"]
+        assert vis.max == [10000]
+    assert len(requests) == 1
+
+
+def test_stretch(monkeypatch):
+    """Missing ranges are stretched over a region at a bounded cost, once."""
+    fake = FakeEE()
+    fake.install(monkeypatch)
+    helpers.STRETCH_CACHE.clear()
+    image = fake.Image("stretch")
+    bbox = [-10, -10, 10, 10]
+    for _ in range(2):
+        vis = layers.VisParams.from_image(image, {"bands": ["B1"], "stretch": bbox})
+        assert (vis.min, vis.max) == ([20], [980])
+    assert fake.round_trips == 1
+    (reduction,) = fake.reductions
+    assert reduction["maxPixels"] == helpers.STRETCH_MAX_PIXELS
+    # the scale makes the box hold about the maximum number of pixels
+    assert 8000 < reduction["scale"] < 9000
+
+    vis = layers.VisParams.from_image(image, {"stretch": bbox, "max": 100})
+    assert (vis.min, vis.max) == ([20, 20, 20], [100, 100, 100])
+    assert fake.round_trips == 3  # the band names and the stretch of the 3 bands
@@ -0,0 +1,448 @@
+"""Test the geeservermap server endpoints."""
+
+import gzip
+import io
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import brotli
+import pytest
+
+from geeservermap import main
+from geeservermap.cache import TileCache
+from geeservermap.compression import Compressor
+from geeservermap.elements import layers
+from geeservermap.metrics import EE_CALLS
+from geeservermap.upstream import Upstream
+from geeservermap.vector import VectorStore
+
+from .fake_ee import FakeEE
+
+
+@pytest.fixture
+def state(tmp_path):
+    """Stores of the app, with an empty layer registry and tile cache."""
+    return main.AppState(
+        tile_cache=TileCache(tmp_path / "tiles"),
+        vectors=VectorStore(tmp_path / "vectors"),
+    )
+
+
+@pytest.fixture
+def client(state):
+    """Flask test client of an app on ``state``."""
+    with main.create_app(state=state).test_client() as client:
+        yield client
+
+
+def test_events_resume(client, state):
+    """A client reconnecting with Last-Event-ID only gets the newer layers."""
+    ids = []
+    for name in ["first", "second"]:
+        params = {"url": "http://tiles/{z}/{x}/{y}", "name": name, "opacity": 1}
+        ids.append(client.get("/add_layer", query_string=params).json["job_id"])
+
+    seq = state.messages[ids[0]]["seq"]
+    response = client.get("/events", headers={"Last-Event-ID": str(seq)})
+    stream = response.response
+    assert next(stream).startswith(b"retry:")
+    event = next(stream).decode()
+    response.close()
+
+    assert f"id: {seq + 1}\n" in event
+    data = json.loads(event.split("data: ")[1])
+    assert list(data) == [ids[1]]
+    assert data[ids[1]]["name"] == "second"
+
+
+def test_events_stale_cursor(client, state):
+    """A client reconnecting with an id from before a restart gets a reset."""
+    params = {"url": "http://tiles/{z}/{x}/{y}", "name": "first", "opacity": 1}
+    layer_id = client.get("/add_layer", query_string=params).json["job_id"]
+
+    response = client.get("/events", headers={"Last-Event-ID": "50"})
+    stream = response.response
+    assert next(stream).startswith(b"retry:")
+    event = next(stream).decode()
+    response.close()
+
+    assert f"id: {state.messages.seq}\nevent: reset\n" in event
+    assert list(json.loads(event.split("data: ")[1])) == [layer_id]
+
+
+def test_messages_since(client, state):
+    """Polling with a cursor only returns new layers and 304 when unchanged."""
+    params = {"url": "http://tiles/{z}/{x}/{y}", "name": "first", "opacity": 1}
+    first = client.get("/add_layer", query_string=params).json["job_id"]
+    params["name"] = "second"
+    second = client.get("/add_layer", query_string=params).json["job_id"]
+
+    response = client.get("/messages")
+    assert set(response.json) == {first, second}
+    etag = response.headers["ETag"]
+
+    seq = state.messages[first]["seq"]
+    response = client.get("/messages", query_string={"since": seq})
+    assert list(response.json) == [second]
+    assert "X-Layers-Reset" not in response.headers
+
+    # a cursor from before a restart of the server
+    response = client.get("/messages", query_string={"since": 50})
+    assert set(response.json) == {first, second}
+    assert response.headers["X-Layers-Reset"] == "1"
+
+    response = client.get("/messages", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_tile_proxy(client, state, monkeypatch):
+    """Tiles are fetched once upstream and then served from the cache."""
+    calls = []
+
+    class Upstream:
+        status_code = 200
+        content = b"\x89PNG tile"
+
+    def get(url, **kwargs):
+        calls.append(url)
+        return Upstream()
+
+    monkeypatch.setattr(state.upstream.session, "get", get)
+    params = {"url": "http://ee/{z}/{x}/{y}", "name": "tiles", "opacity": 1}
+    layer_id = client.get("/add_layer", query_string=params).json["job_id"]
+    assert state.messages[layer_id]["url"] == f"/tiles/{layer_id}/{{z}}/{{x}}/{{y}}"
+
+    for _ in range(2):
+        response = client.get(f"/tiles/{layer_id}/3/4/5")
+        assert response.data == Upstream.content
+        assert response.mimetype == "image/png"
+    assert calls == ["http://ee/3/4/5"]
+
+    etag = response.headers["ETag"]
+    response = client.get(f"/tiles/{layer_id}/3/4/5", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    stats = client.get("/tiles/stats").json
+    assert stats["misses"] == 1
+    assert stats["hits"]["memory"] == 1
+
+
+def test_apps_own_their_layers(tmp_path):
+    """Two apps don't share their layers."""
+    first, second = (
+        main.create_app(
+            state=main.AppState(tile_cache=TileCache(tmp_path))
+        ).test_client()
+        for _ in range(2)
+    )
+    first.get("/add_layer", query_string={"url": "http://tiles/{z}/{x}/{y}"})
+    assert len(first.get("/messages").json) == 1
+    assert second.get("/messages").json == {}
+
+
+def test_tile_cache_eviction(tmp_path):
+    """The least recently used tiles are evicted from disk and memory."""
+    cache = TileCache(tmp_path, max_size=20, memory_size=10)
+    cache.set("a", b"0123456789")
+    cache.set("b", b"0123456789")
+    assert cache.get("a") == b"0123456789"  # from disk, "a" is now the newest
+    cache.set("c", b"0123456789")
+    assert cache.get("b") is None
+    assert TileCache(tmp_path, max_size=20).stats()["disk"]["tiles"] == 2
+
+
+def test_jobs(client, state, monkeypatch):
+    """Map ids are minted by a server job which registers the layer."""
+
+    class FakeImage:
+        """Stand-in of a deserialized ee.Image."""
+
+        def serialize(self):
+            """Serialized expression of the image."""
+            return "expression"
+
+        def getMapId(self, params):
+            """Mint a tile URL."""
+            return {"tile_fetcher": SimpleNamespace(url_format="https://ee/{z}")}
+
+    fake_ee = SimpleNamespace(
+        data=SimpleNamespace(is_initialized=lambda: True),
+        deserializer=SimpleNamespace(fromJSON=lambda expression: FakeImage()),
+        Image=lambda image: image,
+    )
+    monkeypatch.setattr(main, "ee", fake_ee)
+    vis = {"bands": ["B1"], "min": 0, "max": 1}
+    params = {"image": "expression", "visParams": vis, "name": "job", "cache": False}
+    job_id = client.post("/jobs", json=params).json["job_id"]
+
+    for _ in range(100):
+        job = client.get(f"/jobs/{job_id}").json
+        if job["state"] in ["finished", "failed"]:
+            break
+        time.sleep(0.01)
+    assert job["state"] == "finished"
+    layer = state.messages[job["result"]["layer_id"]]
+    assert layer["name"] == "job"
+    assert layer["source"] == "https://ee/{z}"
+    assert client.get(f"/jobs/{job_id}").status_code == 404
+
+
+def test_seed(client, state, monkeypatch):
+    """A seeding job fills the tile cache and reports its progress."""
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        return SimpleNamespace(
+            status_code=404 if url.endswith("/1/1/1") else 200, content=b"tile"
+        )
+
+    monkeypatch.setattr(state.upstream.session, "get", get)
+    params = {"url": "http://ee/{z}/{x}/{y}", "name": "tiles"}
+    layer_id = client.get("/add_layer", query_string=params).json["job_id"]
+    seed = {"layer_id": layer_id, "bbox": [-180, -85, 180, 85], "zooms": [0, 1]}
+    response = client.post("/seed", json=seed).json
+    assert response["tiles"] == 5
+
+    for _ in range(100):
+        job = client.get(f"/jobs/{response['job_id']}").json
+        if job["ready"]:
+            break
+        time.sleep(0.01)
+    assert job["state"] == "finished"
+    assert job["result"] == {"total": 5, "done": 5, "failed": 1}
+    assert sorted(calls)[0] == "http://ee/0/0/0"
+    assert client.get("/tiles/stats").json["disk"]["tiles"] == 4
+
+    seed["zooms"] = [0, 12]
+    assert client.post("/seed", json=seed).status_code == 400
+    for bbox, zooms in [([1, 2, 3], [0, 1]), ([0, 0, 1, 1], [2, 1])]:
+        seed.update(bbox=bbox, zooms=zooms)
+        assert client.post("/seed", json=seed).status_code == 400
+
+
+def test_composite(client, state, monkeypatch):
+    """Stacked layers are blended with their opacity into a single cached tile."""
+    Image = pytest.importorskip("PIL.Image")
+
+    def png(color):
+        out = io.BytesIO()
+        Image.new("RGBA", (256, 256), color).save(out, format="PNG")
+        return out.getvalue()
+
+    tiles = {
+        "http://red/0": png((255, 0, 0, 255)),
+        "http://blue/0": png((0, 0, 255, 255)),
+    }
+    tiles["http://blue/1"] = tiles["http://blue/0"]
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        if url not in tiles:
+            return SimpleNamespace(status_code=503, headers={})
+        return SimpleNamespace(status_code=200, content=tiles[url])
+
+    monkeypatch.setattr(state, "upstream", Upstream(retries=0))
+    monkeypatch.setattr(state.upstream.session, "get", get)
+    ids = [
+        client.post("/add_layer", json={"url": url, "opacity": opacity}).json["job_id"]
+        for url, opacity in [("http://blue/{z}", 1), ("http://red/{z}", 0.5)]
+    ]
+    layer_id = client.post("/add_composite", json={"layer_ids": ids}).json["job_id"]
+    assert all(i not in state.messages for i in ids)
+
+    for _ in range(2):
+        response = client.get(
+            f"/tiles/{layer_id}/0/0/0", headers={"Accept": "image/webp"}
+        )
+        assert response.mimetype == "image/webp"
+    assert sorted(calls) == ["http://blue/0", "http://red/0"]
+    pixel = Image.open(io.BytesIO(response.data)).convert("RGBA").getpixel((0, 0))
+    assert [abs(c - e) <= 2 for c, e in zip(pixel, (128, 0, 127, 255))] == [True] * 4
+    response = client.get(f"/tiles/{layer_id}/0/0/0")
+    assert response.mimetype == "image/png"
+
+    # the blend missing a layer that failed upstream isn't cached
+    for _ in range(2):
+        response = client.get(f"/tiles/{layer_id}/1/0/0")
+        assert response.status_code == 200
+        assert response.cache_control.no_store
+    assert calls.count("http://red/1") == 2
+
+
+def test_compression(client, state, monkeypatch):
+    """JSON is compressed with the preferred encoding, once for identical bodies."""
+    monkeypatch.setattr(main, "COMPRESSOR", Compressor())
+    for i in range(20):
+        client.get("/add_layer", query_string={"url": f"https://ee/{i}/{{z}}"})
+
+    headers = {"Accept-Encoding": "gzip;q=0.5, br"}
+    for _ in range(2):
+        response = client.get("/messages", headers=headers)
+        assert response.headers["Content-Encoding"] == "br"
+        assert "Accept-Encoding" in response.headers["Vary"]
+        layers = json.loads(brotli.decompress(response.data))
+        assert len(layers) == 20
+    assert main.COMPRESSOR.cache.stats()["hits"] == 1
+
+    response = client.get("/messages", headers={"Accept-Encoding": "gzip"})
+    assert json.loads(gzip.decompress(response.data)) == layers
+    assert "Content-Encoding" not in client.get("/messages").headers
+    since = state.messages.seq - 1
+    response = client.get(f"/messages?since={since}", headers=headers)
+    assert "Content-Encoding" not in response.headers  # under the minimum size
+
+
+def test_metrics(client, monkeypatch):
+    """Requests, EE calls, layers and caches are exposed in the text format."""
+    fake = FakeEE()
+    fake.install(monkeypatch)
+    calls = EE_CALLS.count("getMapId")
+    vis = layers.VisParams.from_image(fake.Image("metrics"))
+    for _ in range(2):
+        layers.Image(fake.Image("metrics"), vis).url
+    assert EE_CALLS.count("getMapId") == calls + 1
+    requests = main.REQUESTS.count("GET", "/add_layer", 200)
+    client.get("/add_layer", query_string={"url": "https://ee/{z}"})
+    assert main.REQUESTS.count("GET", "/add_layer", 200) == requests + 1
+
+    response = client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert "geeservermap_layers 1" in text
+    route = 'method="GET",route="/add_layer",status="200"'
+    assert f"geeservermap_request_seconds_count{{{route}}} {requests + 1}" in text
+    assert 'geeservermap_ee_call_seconds_count{call="bandsInfo"}' in text
+    assert 'geeservermap_cache_hit_ratio{cache="mapids"}' in text
+    assert 'geeservermap_jobs{state="queued"} 0' in text
+
+
+def test_viewport(client):
+    """The browser posts its viewport, clamped to the valid coordinates."""
+    assert client.get("/viewport").json["bbox"] is None
+    client.post("/viewport", json={"bbox": [-200, -10, 10, 10], "zoom": 4})
+    assert client.get("/viewport").json == {"bbox": [-180, -10, 10, 10], "zoom": 4}
+    assert client.post("/viewport", json={"bbox": [1]}).status_code == 400
+
+
+def test_remove_layers(client, state):
+    """Removed layers are reported to the polling clients as tombstones."""
+    params = {"url": "http://tiles/{z}/{x}/{y}", "name": "layer", "opacity": 1}
+    ids = [client.get("/add_layer", query_string=params).json["job_id"] for _ in "ab"]
+    seq = state.messages.seq
+
+    assert client.delete(f"/layers/{ids[0]}").json == {"removed": 1}
+    assert client.delete(f"/layers/{ids[0]}").status_code == 404
+    assert list(client.get("/messages").json) == [ids[1]]
+    response = client.get("/messages", query_string={"since": seq})
+    assert response.json[ids[0]]["removed"]
+
+    assert client.post("/layers/clear").json == {"removed": 1}
+    assert client.get("/messages").json == {}
+
+
+def test_vector_layer(client, state):
+    """Vector layers are served in tiles and deleted with their layer."""
+    geometry = {"type": "Point", "coordinates": [10.123456, 20.123456]}
+    geojson = {"type": "FeatureCollection", "features": [{"geometry": geometry}]}
+    params = {"geojson": geojson, "name": "points", "opacity": 1, "color": "red"}
+    layer_id = client.post("/add_vector", json=params).json["job_id"]
+    layer = state.messages[layer_id]
+    assert layer["url"] == f"/vector/{layer_id}/{{z}}/{{x}}/{{y}}"
+    assert "geojson" not in layer
+
+    features = client.get(f"/vector/{layer_id}/0/0/0").json["features"]
+    assert features[0]["geometry"]["coordinates"] == [10.1, 20.1]
+    assert client.get(f"/vector/{layer_id}/1/0/0").json["features"] == []
+
+    client.delete(f"/layers/{layer_id}")
+    assert client.get(f"/vector/{layer_id}/0/0/0").status_code == 404
+    assert not list(state.vectors.directory.glob("*.geojson"))
+
+
+def test_sessions(client):
+    """The layers of a named session are only shown in that session."""
+    params = {"url": "http://tiles/{z}/{x}/{y}", "name": "layer", "opacity": 1}
+    layer_id = client.get("/s/alice/add_layer", query_string=params).json["job_id"]
+
+    layers = client.get("/s/alice/messages").json
+    assert layers[layer_id]["url"] == f"/s/alice/tiles/{layer_id}/{{z}}/{{x}}/{{y}}"
+    assert layer_id not in client.get("/messages").json
+    assert client.get("/s/bob/messages").json == {}
+    assert client.get(f"/tiles/{layer_id}/0/0/0").status_code == 404
+    assert b'var base = "/s/alice"' in client.get("/s/alice/").data
+    assert client.get("/s/not%20valid/messages").status_code == 404
+    assert client.post("/s/alice/layers/clear").json == {"removed": 1}
+
+
+def test_session_reads(client, state):
+    """Reading a session doesn't create it, its stream waits for its first layer."""
+    assert client.get("/s/bob/messages").json == {}
+    assert client.get("/s/bob/viewport").json["bbox"] is None
+    assert client.delete("/s/bob/layers/x").status_code == 404
+    assert len(state.sessions) == 0
+
+    response = client.get("/s/bob/events")
+    stream = response.response
+    assert next(stream).startswith(b"retry:")
+    # the stream sends a reset when the session is opened, then its layers
+    threading.Timer(0.05, state.sessions.get, ("bob", True)).start()
+    assert "event: reset\ndata: {}" in next(stream).decode()
+    state.registry("bob").add({"name": "layer"})
+    assert "event: layer\n" in next(stream).decode()
+    response.close()
+
+    # the session with a layer isn't closed to open another one
+    state.sessions.max_sessions = 1
+    params = {"url": "http://tiles/{z}/{x}/{y}", "name": "layer", "opacity": 1}
+    assert client.get("/s/carol/add_layer", query_string=params).status_code == 503
+
+
+def test_inspect(client, monkeypatch):
+    """The pixels of all the image layers are sampled in one request and cached."""
+    fake = FakeEE(bands=["B1", "B2"])
+    fake.install(monkeypatch)
+    params = {"url": "http://tiles/{z}/{x}/{y}", "opacity": 1}
+    ids = [
+        client.post("/add_layer", json={**params, "name": n, "image": n}).json["job_id"]
+        for n in ["a", "b"]
+    ]
+    client.post("/add_layer", json={**params, "name": "no image"})
+    point = {"lon": 2.35, "lat": 48.85, "zoom": 10}
+    sent = client.get("/messages").json
+    inspect = {layer["name"]: layer.get("inspect") for layer in sent.values()}
+    assert inspect == {"a": True, "b": True, "no image": None}
+    assert all("image" not in layer for layer in sent.values())
+
+    layers = client.post("/inspect", json=point).json["layers"]
+    assert layers == {
+        ids[0]: {"name": "a", "values": {"B1": 1, "B2": 2}},
+        ids[1]: {"name": "b", "values": {"B1": 1, "B2": 2}},
+    }
+    assert fake.round_trips == 1
+    assert fake.reductions[0]["geometry"].coords == [2.35, 48.85]
+
+    nearby = {**point, "lon": 2.35001, "layer_ids": ids[:1]}
+    assert list(client.post("/inspect", json=nearby).json["layers"]) == ids[:1]
+    assert fake.round_trips == 1
+    assert client.post("/inspect", json={"lon": 1}).status_code == 400
+
+
+def test_parser():
+    """The command line options are parsed with their types."""
+    args = main.parser.parse_args(["--port", "9000", "--width", "800", "--debug"])
+    assert (args.port, args.width, args.height) == (9000, 800, main.HEIGHT)
+    assert args.debug
+    assert not main.parser.parse_args([]).debug
+
+
+def test_jobs_need_single_worker():
+    """The jobs, local to a process, are refused when there are several workers."""
+    client = main.create_app(workers=2).test_client()
+    assert client.post("/jobs", json={"image": "image"}).status_code == 501
+    assert client.get("/jobs/unknown").status_code == 501
+    assert client.get("/viewport").status_code == 200
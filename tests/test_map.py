@@ -0,0 +1,147 @@
+"""Test the Map client against the server test client."""
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from geeservermap import main, map, tracing
+from geeservermap.cache import TileCache
+from geeservermap.exceptions import ServerNotRunning
+from geeservermap.transport import Transport
+
+from .fake_ee import FakeEE
+
+
+class FakeImage:
+    """Stand-in of an ee.Image."""
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """Route the requests of the Map client to the Flask test client."""
+    state = main.AppState(tile_cache=TileCache(tmp_path / "tiles"))
+    client = main.create_app(state=state).test_client()
+    client.state = state
+
+    def request(self, method, path, json=None, params=None, **kwargs):
+        """Send the request to the test client."""
+        path = self.prefix + path
+        return client.open(path, method=method, json=json, query_string=params).json
+
+    monkeypatch.setattr(Transport, "request", request)
+    monkeypatch.setattr(map, "ee", SimpleNamespace(Image=FakeImage))
+    yield client
+
+
+def test_add_layers(server, monkeypatch):
+    """A batch is registered at once and a bad layer doesn't abort it."""
+
+    def image_layer(self, image, visParams=None, name=None, shown=True, opacity=1):
+        if visParams == "bad":
+            raise ValueError("bad visParams")
+        return {"url": "https://ee/{z}/{x}/{y}", "name": name, "opacity": opacity}
+
+    monkeypatch.setattr(map.Map, "_imageLayer", image_layer)
+    results = map.Map().addLayers(
+        [
+            {"layer": FakeImage(), "name": "first"},
+            {"layer": FakeImage(), "visParams": "bad"},
+            {"layer": "not an image"},
+            FakeImage(),
+        ]
+    )
+    assert results[1] == {"error": "bad visParams"}
+    assert "error" in results[2]
+    assert server.state.messages[results[0]["job_id"]]["name"] == "first"
+    assert results[3]["job_id"] in server.state.messages
+    assert len(server.state.messages) == 2
+
+    response = server.post("/add_layers", json=[{"name": "ok"}, 1])
+    assert response.status_code == 400
+    assert len(server.state.messages) == 2
+
+
+def test_server_not_running():
+    """A refused connection fails over to ServerNotRunning."""
+    with pytest.raises(ServerNotRunning):
+        Transport(port=1).get("/messages")
+
+
+def test_retries():
+    """Only the idempotent requests are retried on a gateway error."""
+    retry = Transport(port=1).session.get_adapter("http://").max_retries
+    assert retry.is_retry("GET", 502) and retry.is_retry("DELETE", 504)
+    assert not retry.is_retry("POST", 502) and not retry.is_retry("POST", 504)
+    assert retry.is_retry("POST", 503)
+
+
+def test_retries_exhausted():
+    """The 503 of the server is raised once the retries are exhausted."""
+    calls = []
+
+    class Busy(BaseHTTPRequestHandler):
+        def do_POST(self):
+            calls.append(self.path)
+            body = b'{"error": "too many jobs"}'
+            self.send_response(503)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(("localhost", 0), Busy)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        with pytest.raises(requests.HTTPError) as error:
+            Transport(port=httpd.server_port, backoff=0).post("/jobs", {})
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert error.value.response.status_code == 503
+    assert error.value.response.json() == {"error": "too many jobs"}
+    assert len(calls) == 3
+
+
+def test_trace(server, monkeypatch, tmp_path):
+    """A traced Map reports the stages of each call and profiles the slowest."""
+    fake = FakeEE(latency=0.01)
+    fake.install(monkeypatch)
+    m = map.Map(trace=True, profile=1)
+    layer_ids = [m.addLayer(fake.Image(f"trace-{i}")) for i in range(2)]
+    m.addLayer(fake.Image("trace-0"))  # cached
+
+    timings = m.report()
+    assert [t["layer_id"] for t in timings[:2]] == layer_ids
+    assert timings[0]["stages"]["bandsInfo"] >= 10
+    assert timings[0]["stages"]["getMapId"] >= 10
+    assert "getMapId" not in timings[2]["stages"]
+    assert all(t.get("pickup") is None for t in timings)
+
+    server.get("/messages")
+    assert all(t["pickup"] >= 0 for t in m.report())
+    (path,) = m.dump_profiles(tmp_path)
+    assert path.stat().st_size > 0
+
+
+def test_server_timing(server):
+    """The server times the stages of the requests that ask for it."""
+    assert "Server-Timing" not in server.get("/messages").headers
+    response = server.get("/messages", headers={tracing.HEADER: "1"})
+    timing = tracing.parse_server_timing(response.headers["Server-Timing"])
+    assert timing["total"] > 0
+
+
+def test_session(server, monkeypatch):
+    """A Map adds its layers to its session."""
+    fake = FakeEE()
+    fake.install(monkeypatch)
+    m = map.Map(session="notebook")
+    m.addLayer(fake.Image("session"), name="tiles")
+    assert server.get("/messages").json == {}
+    (layer,) = server.get("/s/notebook/messages").json.values()
+    assert layer["name"] == "tiles"
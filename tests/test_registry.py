@@ -0,0 +1,118 @@
+"""Test the layer registry."""
+
+import threading
+
+import pytest
+
+from geeservermap.exceptions import TooManySessions
+from geeservermap.registry import BaseRegistry, LayerRegistry, Sessions, open_registry
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    """Build a layer store of each backend."""
+
+    def store(max_size):
+        return open_registry(request.param, tmp_path / "layers.db", max_size)
+
+    return store
+
+
+def test_eviction(store):
+    """The oldest layers are evicted and reported as removed."""
+    registry = store(max_size=2)
+    ids = [registry.add({"name": name}) for name in "abc"]
+    assert list(registry.layers()) == ids[1:]
+
+    changes, reset = registry.changes(registry[ids[1]]["seq"])
+    assert not reset
+    assert changes == {ids[0]: {"seq": 4, "removed": True}, ids[2]: registry[ids[2]]}
+
+
+def test_reset(store):
+    """A client missing forgotten tombstones is told to reset."""
+    registry = store(max_size=1)
+    first = registry.add({"name": "a"})
+    seq = registry.seq
+    registry.remove(first)
+    registry.add({"name": "b"})
+    assert registry.clear() == 1
+
+    changes, reset = registry.changes(seq)
+    assert reset
+    assert changes == {}
+    assert not registry.wait(registry.seq, timeout=0)
+
+
+def test_stale_cursor(store):
+    """A cursor ahead of the registry, e.g. after a restart, is told to reset."""
+    registry = store(max_size=2)
+    layer_id = registry.add({"name": "a"})
+    registry.add({"name": "b"})
+    changes, reset = registry.changes(50)
+    assert reset
+    assert list(changes) == list(registry.layers())
+    assert layer_id in changes
+
+
+def test_sqlite_shared(tmp_path):
+    """Two sqlite stores on the same database see each other's changes."""
+    first = open_registry("sqlite", tmp_path / "layers.db")
+    second = open_registry("sqlite", tmp_path / "layers.db")
+    layer_id = first.add({"name": "shared"})
+    assert second.wait(0, timeout=1)
+    assert second[layer_id] == {"name": "shared", "seq": 1}
+    assert second.remove(layer_id)
+    assert layer_id not in first
+
+
+def test_viewport(store):
+    """The viewport is kept apart from the layers."""
+    registry = store(max_size=2)
+    assert registry.viewport() is None
+    registry.set_viewport({"bbox": [0, 0, 1, 1], "zoom": 3})
+    assert registry.viewport() == {"bbox": [0, 0, 1, 1], "zoom": 3}
+    assert len(registry) == 0 and registry.seq == 0
+
+
+def test_incomplete_store():
+    """A store missing a method of the interface can't be created."""
+
+    class NoViewport(LayerRegistry):
+        viewport = BaseRegistry.viewport
+
+    with pytest.raises(TypeError):
+        NoViewport()
+
+
+def test_sessions_memory():
+    """Reading doesn't open a session and the sessions with layers are kept."""
+    sessions = Sessions(max_sessions=2)
+    assert sessions.get("alice") is None
+    sessions.get("alice", create=True).add({"name": "a"})
+    sessions.get("empty", create=True)
+    assert len(sessions) == 2
+    sessions.get("bob", create=True).add({"name": "b"})
+    assert sessions.get("empty") is None
+    assert len(sessions.get("alice")) == 1
+    with pytest.raises(TooManySessions):
+        sessions.get("carol", create=True)
+
+
+def test_sessions_sqlite(tmp_path):
+    """Reading doesn't create the database of a session, another process can."""
+    sessions = Sessions("sqlite", tmp_path / "layers.db", max_sessions=1)
+    assert sessions.get("alice") is None
+    assert not list(tmp_path.iterdir())
+    Sessions("sqlite", tmp_path / "layers.db").get("alice", create=True).add({})
+    assert len(sessions.get("alice")) == 1
+    sessions.get("bob", create=True)
+    assert len(sessions.get("alice")) == 1
+
+
+def test_sessions_wait():
+    """Waiting for a session ends when it's opened."""
+    sessions = Sessions()
+    assert sessions.wait("alice", timeout=0) is None
+    threading.Timer(0.05, sessions.get, ("alice", True)).start()
+    assert sessions.wait("alice", timeout=5) is sessions.get("alice")
@@ -0,0 +1,65 @@
+"""Test the production server."""
+
+import threading
+import time
+
+import pytest
+import requests
+
+from geeservermap.serving import PooledWSGIServer
+
+STOP = threading.Event()
+
+
+def app(environ, start_response):
+    """Stream until stopped on ``/events``, answer after ``?sleep`` seconds otherwise."""
+    if environ["PATH_INFO"] == "/events":
+        start_response("200 OK", [("Content-Type", "text/event-stream")])
+
+        def stream():
+            while not STOP.wait(0.05):
+                yield b": heartbeat\n\n"
+
+        return stream()
+    time.sleep(float(environ["QUERY_STRING"] or 0))
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"done"]
+
+
+@pytest.fixture
+def server():
+    """A server running one request at a time on a free port."""
+    STOP.clear()
+    server = PooledWSGIServer("127.0.0.1", 0, app, threads=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    STOP.set()
+    if thread.is_alive():
+        server.shutdown()
+        server.drain()
+    thread.join()
+
+
+def test_streams_dont_block(server):
+    """Open streams don't take the slots of the other requests."""
+    streams = [requests.get(server.url + "/events", stream=True) for _ in range(3)]
+    assert requests.get(server.url + "/viewport", timeout=5).text == "done"
+    STOP.set()
+    for stream in streams:
+        stream.close()
+
+
+def test_drain(server):
+    """Shutting down waits for the requests in flight."""
+    responses = []
+    thread = threading.Thread(
+        target=lambda: responses.append(requests.get(server.url + "/?0.3").text)
+    )
+    thread.start()
+    time.sleep(0.1)
+    server.shutdown()
+    server.drain()
+    thread.join()
+    assert responses == ["done"]
@@ -0,0 +1,58 @@
+"""Test the client of the upstream tile servers."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from geeservermap.upstream import TokenBucket, Upstream
+
+
+def test_coalescing(monkeypatch):
+    """Concurrent fetches of the same tile share one request."""
+    upstream = Upstream()
+    release = threading.Event()
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        release.wait(5)
+        return SimpleNamespace(status_code=200, content=b"tile")
+
+    monkeypatch.setattr(upstream.session, "get", get)
+    with ThreadPoolExecutor(8) as pool:
+        results = [pool.submit(upstream.get, "http://ee/1/2/3") for _ in range(8)]
+        while upstream.stats["coalesced"] < 7:
+            time.sleep(0.001)
+        release.set()
+    assert [r.result() for r in results] == [(200, b"tile")] * 8
+    assert calls == ["http://ee/1/2/3"]
+    assert upstream.get("http://ee/1/2/3") == (200, b"tile")
+    assert len(calls) == 2  # nothing in flight anymore
+
+
+def test_retries(monkeypatch):
+    """Throttled requests are retried, the other errors are returned at once."""
+    upstream = Upstream(retries=2, backoff=0)
+    statuses = {"http://ee/throttled": [429, 429, 200], "http://ee/missing": [404]}
+
+    def get(url, **kwargs):
+        status = statuses[url].pop(0)
+        return SimpleNamespace(status_code=status, content=b"tile", headers={})
+
+    monkeypatch.setattr(upstream.session, "get", get)
+    assert upstream.get("http://ee/throttled") == (200, b"tile")
+    assert upstream.get("http://ee/missing") == (404, None)
+    assert upstream.stats == {"requests": 4, "coalesced": 0, "retries": 2}
+
+    statuses["http://ee/throttled"] = [503] * 3
+    assert upstream.get("http://ee/throttled") == (503, None)
+
+
+def test_token_bucket():
+    """Once the burst is spent, tokens are handed out at the rate."""
+    bucket = TokenBucket(rate=100, burst=5)
+    start = time.monotonic()
+    for _ in range(10):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.04
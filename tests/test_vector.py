@@ -0,0 +1,67 @@
+"""Test the vector layers served by tiles."""
+
+import math
+
+from geeservermap import vector
+
+
+def square(west, south, size):
+    """GeoJSON feature of a square with a lot of aligned points on its edges."""
+    edge = [i / 10 * size for i in range(10)]
+    ring = (
+        [[west + d, south] for d in edge]
+        + [[west + size, south + d] for d in edge]
+        + [[west + size - d, south + size] for d in edge]
+        + [[west, south + size - d] for d in edge]
+        + [[west, south]]
+    )
+    geometry = {"type": "Polygon", "coordinates": [ring]}
+    return {"type": "Feature", "geometry": geometry, "properties": {}}
+
+
+def test_simplify():
+    """Aligned points are removed and the shape is kept."""
+    ring = square(0, 0, 1)["geometry"]["coordinates"][0]
+    assert vector.simplify(ring, 1e-6) == [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]
+
+
+def test_tile():
+    """Only the features of a tile that are bigger than a pixel are served."""
+    index = vector.VectorIndex(
+        {"features": [square(1, 1, 0.5), square(100, 10, 0.5), square(2, 2, 1e-4)]}
+    )
+    features = index.tile(6, 32, 31)["features"]
+    assert [f["id"] for f in features] == [0]
+    assert len(features[0]["geometry"]["coordinates"][0]) == 5
+
+    features = index.tile(16, *vector.tile_range((2, 2, 2, 2), 16)[:2])["features"]
+    assert [f["id"] for f in features] == [2]
+
+
+def test_clip():
+    """Lines are split where they leave the bounds, rings follow the bounds."""
+    line = [[-2, 0], [0, 0], [2, 0], [2, 2], [0, 2], [0, 4]]
+    assert vector.clip_line(line, (-1, -1, 1, 3)) == [
+        [[-1, 0], [0, 0], [1, 0]],
+        [[1, 2], [0, 2], [0, 3]],
+    ]
+    ring = square(0, 0, 4)["geometry"]["coordinates"][0]
+    clipped = vector.clip_ring(ring, (1, 1, 2, 2))
+    assert {tuple(p) for p in clipped} == {(1, 1), (2, 1), (2, 2), (1, 2)}
+
+
+def test_tile_clipped():
+    """A large feature is clipped to each tile instead of being sent whole."""
+    n = 10000
+    ring = [
+        [math.cos(2 * math.pi * i / n), math.sin(2 * math.pi * i / n)] for i in range(n)
+    ]
+    geometry = {"type": "Polygon", "coordinates": [ring + ring[:1]]}
+    index = vector.VectorIndex(
+        {"features": [{"type": "Feature", "geometry": geometry}]}
+    )
+    # a tile on the edge of the disk and one inside it
+    edge = index.tile(13, *vector.tile_range((1, 0, 1, 0), 13)[:2])["features"]
+    inside = index.tile(13, *vector.tile_range((0, 0, 0, 0), 13)[:2])["features"]
+    assert 0 < len(edge[0]["geometry"]["coordinates"][0]) < 50
+    assert len(inside[0]["geometry"]["coordinates"][0]) == 5